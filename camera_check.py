@@ -4,37 +4,32 @@
 # In[7]:
 
 import cv2
-import numpy
+# probing, the camera cache and warm up live in cp_rewrite; importing it does not start main()
+import cp_rewrite
 
 
 # In[8]:
 
-def checkCams():
-    '''enumerate the connected and readable video devices'''
-    cameraList = []
-    for i in range(0, 10):
-        try:
-            connected, _ = cv2.VideoCapture(i).read()
-        except Excpetion, e:
-            print 'video device', i, 'not avaialble - this is OK!'
-        cv2.VideoCapture(i).release()
-        if connected:
-            cameraList.append(i)
-    return cameraList
+def checkCams(deadline = 2.0, camCache = './cameras.pick'):
+    '''enumerate the connected and readable video devices concurrently
+    each device gets <deadline> seconds; the result is saved to the cp_rewrite camera cache'''
+    cams = cp_rewrite.probeCams(range(0, 10), deadline)
+    cp_rewrite.CameraCache(camCache).saveCams(cams)
+    for i in sorted(cams):
+        print 'video device', i, cams[i]
+    return sorted(cams.keys())
 
 cams = checkCams()
 print 'found camera devices at:', cams
 
-for i in range(0, 30):
-    cap = cv2.VideoCapture(0)
-    _, frame = cap.read()
-    cv2.imshow('foo' , frame)
-cap.release()
+# read until auto exposure/white balance settle
+myFrame = cp_rewrite.cvFrame(0)
+ready, frames, warmTime = myFrame.warmUp(winName = 'foo')
+print 'camera ready:', ready, 'after', frames, 'frames', round(warmTime, 2), 's'
+myFrame.cap.release()
 cv2.destroyAllWindows()
 cv2.waitKey(1)
 
 
 # In[ ]:
 
-
-
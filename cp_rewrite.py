@@ -6,13 +6,56 @@
 # In[ ]:
 
 import re
+import os
 import cv2
 import numpy as np
 import copy
 import time
+import random
 import websocket
+import wire_protocol
 import ConfigParser
 import pickle
+import json
+import math
+import threading
+import collections
+import heapq
+import multiprocessing
+import multiprocessing.pool
+import Queue
+import resource
+import mmap
+import ctypes
+import ctypes.util
+import select
+import fcntl
+try:
+    import tracemalloc
+except ImportError:
+    # python 2.7 has no tracemalloc; checkAllocations falls back to buffer identity
+    tracemalloc = None
+try:
+    from time import monotonic
+except ImportError:
+    # python 2.7 has no time.monotonic; wall time can step backwards (NTP, manual changes) and
+    # would stall every Scheduler deadline, so call clock_gettime(CLOCK_MONOTONIC) directly
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    
+    CLOCK_MONOTONIC = 6 if os.uname()[0] == 'Darwin' else 1
+    clockLib = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+                           use_errno = True)
+    clockGettime = clockLib.clock_gettime
+    clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    
+    def monotonic():
+        '''seconds from a clock that never steps backwards (time.monotonic for python 2.7)'''
+        now = timespec()
+        if clockGettime(CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return now.tv_sec + now.tv_nsec * 1e-9
 
 
 # # Functions
@@ -60,6 +103,120 @@ def ratio(countA, countB):
     return(percent)
 
 
+def ratioInterval(countA, countB, z = 1.96):
+    '''ratio() before the dead-band, with an approximate confidence interval
+    counts are treated as Poisson; the interval is the delta-method bound on the smaller
+    count over the larger one
+    returns (ratio, low, high)'''
+    if countA == countB:
+        if countA == 0:
+            return (0.0, -1.0, 1.0)
+        spread = z * np.sqrt(2.0 / countA)
+        return (0.0, max(-1.0, -spread), min(1.0, spread))
+    sign = -1 if countA > countB else 1
+    big, small = float(max(countA, countB)), float(min(countA, countB))
+    q = small / big
+    # half a count keeps the interval open when the smaller channel was not seen at all
+    sd = q * np.sqrt(1.0 / big + 1.0 / max(small, .5))
+    if small == 0:
+        sd = np.sqrt(.5) / big
+    value = sign * (1 - q)
+    bound1 = sign * (1 - max(0.0, q - z * sd))
+    bound2 = sign * (1 - min(1.0, q + z * sd))
+    return (value, min(bound1, bound2), max(bound1, bound2))
+
+
+def probeCam(index):
+    '''open a video device, read one frame and describe it
+    returns a dictionary (index, width, height, fps) or None if the device is not readable'''
+    cap = cv2.VideoCapture(index)
+    try:
+        if not cap.isOpened():
+            return None
+        connected, frame = cap.read()
+        if not connected or frame is None:
+            return None
+        # 5 = CAP_PROP_FPS; many backends report 0 when unknown
+        return {'index': index, 'width': frame.shape[1], 'height': frame.shape[0],
+                'fps': cap.get(5)}
+    finally:
+        cap.release()
+
+
+def fourcc(code):
+    '''pack a four character code (e.g. 'MJPG') into the integer used by CAP_PROP_FOURCC'''
+    return ord(code[0]) | (ord(code[1]) << 8) | (ord(code[2]) << 16) | (ord(code[3]) << 24)
+
+
+def probeCams(indexes = range(0, 10), deadline = 2.0):
+    '''probe video devices concurrently, one thread per device
+    indexes - device indexes to try
+    deadline - seconds to wait for each device before giving up on it
+    returns a dictionary index: probeCam() result for every readable device'''
+    found = {}
+    lock = threading.Lock()
+    
+    def worker(i):
+        try:
+            info = probeCam(i)
+        except Exception, e:
+            print 'video device', i, 'not avaialble - this is OK!', e
+            info = None
+        if info is not None:
+            with lock:
+                found[i] = info
+    
+    workers = []
+    for i in indexes:
+        # daemon threads so a hung device can not keep the process alive
+        t = threading.Thread(target = worker, args = (i,))
+        t.daemon = True
+        t.start()
+        workers.append(t)
+    
+    endTime = time.time() + deadline
+    for t in workers:
+        t.join(max(0, endTime - time.time()))
+    with lock:
+        return dict(found)
+
+
+def camWorker(videoDev, frameWidth, settings, settingsQueue, resultQueue, stopEvent):
+    '''capture and classify one video device in its own process (see CamFanIn)
+    settings - dictionary name: (lower, upper) HSV lists
+    settingsQueue - replacement settings dictionaries sent by the parent
+    resultQueue - receives (videoDev, capture time, dictionary name: nonzero count,
+                  number of pixels classified)
+    results are dropped rather than blocking when resultQueue is full'''
+    cap = cv2.VideoCapture(videoDev)
+    while not stopEvent.is_set():
+        # only the newest settings matter
+        try:
+            while True:
+                settings = settingsQueue.get_nowait()
+        except Queue.Empty:
+            pass
+        ok, frame = cap.read()
+        captureTime = time.time()
+        if not ok or frame is None:
+            time.sleep(.01)
+            continue
+        r = float(frameWidth) / frame.shape[1]
+        dim = (int(frameWidth), int(frame.shape[0] * r))
+        frame = cv2.resize(frame, dim, interpolation = cv2.INTER_AREA)
+        hsvFrame = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+        pixels = hsvFrame.shape[0] * hsvFrame.shape[1]
+        counts = {}
+        for name in settings:
+            lower, upper = settings[name]
+            counts[name] = cv2.countNonZero(cv2.inRange(hsvFrame, np.array(lower), np.array(upper)))
+        try:
+            resultQueue.put_nowait((videoDev, captureTime, counts, pixels))
+        except Queue.Full:
+            pass
+    cap.release()
+
+
 # # Classes
 
 # In[ ]:
@@ -170,10 +327,334 @@ class KeyHandler:
         else:
             # set to empty if no key or an unknown key was pressed
             self.methodReturn = []
+        # methods return (code, message) tuples
+        if isinstance(self.methodReturn, tuple):
+            self.methodReturn = list(self.methodReturn)
         # set to empty if None was returned    
         if not isinstance(self.methodReturn, list):
                 self.methodReturn = []
 
+
+class FrameGrabber(threading.Thread):
+    '''read frames from a capture device on a dedicated thread
+    the newest frames are kept in a small ring buffer; stale frames are dropped, never queued'''
+    def __init__(self, cap, bufferSize = 2):
+        '''cap - opened cv2.VideoCapture object
+        ring - ring buffer of (sequence, capture time, frame) tuples
+        newFrame - event set whenever a frame is added to the ring
+        onFrame - optional callable run on this thread after newFrame is set (Scheduler.wakeUp)
+        captured - number of frames read from the device
+        dropped - number of frames that were never handed to the consumer
+        consumed - number of frames handed to the consumer
+        lastAge - seconds between capturing and handing out the last frame
+        lastCaptureTime - time the last frame handed out was captured
+        ageTotal - sum of lastAge over every consumed frame'''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cap = cap
+        self.ring = collections.deque(maxlen = bufferSize)
+        self.lock = threading.Lock()
+        self.newFrame = threading.Event()
+        self.onFrame = None
+        self.running = False
+        self.seq = 0
+        self.lastSeq = 0
+        self.lastFrame = None
+        self.captured = 0
+        self.dropped = 0
+        self.consumed = 0
+        self.lastAge = 0.0
+        self.lastCaptureTime = None
+        self.ageTotal = 0.0
+    
+    def handedOut(self, seq, captureTime):
+        '''update counters when frame <seq> is handed to the consumer; call with self.lock held'''
+        # every frame between the last one handed out and this one is stale
+        self.dropped += seq - self.lastSeq - 1
+        self.consumed += 1
+        self.lastSeq = seq
+        self.lastAge = time.time() - captureTime
+        self.lastCaptureTime = captureTime
+        self.ageTotal += self.lastAge
+    
+    def run(self):
+        '''producer loop: read frames as fast as the device delivers them'''
+        self.running = True
+        while self.running:
+            try:
+                ok, frame = self.cap.read()
+            except Exception, e:
+                print 'error reading frame:', e
+                ok = False
+            if not ok or frame is None:
+                # avoid spinning on a dead device
+                time.sleep(.01)
+                continue
+            with self.lock:
+                self.seq += 1
+                self.captured += 1
+                self.ring.append((self.seq, time.time(), frame))
+            self.newFrame.set()
+            if self.onFrame is not None:
+                self.onFrame()
+    
+    def expect(self, delay):
+        '''hint that the consumer reads again in about delay seconds; unused here because
+        every frame is decoded anyway (see LazyGrabber)'''
+        pass
+    
+    def stop(self, timeout = 1.0):
+        '''signal the producer loop to stop and wait for it'''
+        self.running = False
+        if self.is_alive():
+            self.join(timeout)
+    
+    def latest(self, timeout = 0):
+        '''return the newest frame without blocking
+        timeout - seconds to wait if no frame has ever been captured
+        returns None if no frame is available'''
+        if self.lastFrame is None and timeout > 0:
+            self.newFrame.wait(timeout)
+        with self.lock:
+            if len(self.ring) == 0:
+                return self.lastFrame
+            seq, captureTime, frame = self.ring[-1]
+            if seq != self.lastSeq:
+                self.handedOut(seq, captureTime)
+            self.ring.clear()
+            self.newFrame.clear()
+        self.lastFrame = frame
+        return frame
+    
+    def stats(self):
+        '''return a dictionary of capture statistics'''
+        meanAge = 0.0
+        if self.consumed > 0:
+            meanAge = self.ageTotal / self.consumed
+        return {'captured': self.captured, 'dropped': self.dropped, 'consumed': self.consumed,
+                'lastAge': round(self.lastAge, 4), 'meanAge': round(meanAge, 4)}
+
+
+class LazyGrabber(FrameGrabber):
+    '''keep the driver queue drained with grab() and only decode with retrieve() when a frame
+    is about to be read; the consumer never touches cap
+    after latest() the producer stops decoding until about one frame interval before the
+    consumer's next read (see expect), then decodes every frame it grabs until that read, so
+    the frame handed out is at most about one frame interval old'''
+    def __init__(self, cap, bufferSize = 1):
+        '''wantAt - grab time from which frames are decoded
+        frameInterval - smoothed seconds between grabbed frames
+        lastGrab - time of the last successful grab
+        decoded - number of frames decoded'''
+        FrameGrabber.__init__(self, cap, bufferSize)
+        self.wantAt = 0.0
+        self.frameInterval = 1 / 30.0
+        self.lastGrab = None
+        self.decoded = 0
+    
+    def expect(self, delay):
+        '''the consumer calls latest() again in about delay seconds; decode from one frame
+        interval before then'''
+        self.wantAt = time.time() + delay - self.frameInterval
+    
+    def run(self):
+        '''producer loop: grab every frame the device delivers, decode only the ones that can
+        still be handed out fresh'''
+        self.running = True
+        while self.running:
+            try:
+                ok = self.cap.grab()
+            except Exception, e:
+                print 'error grabbing frame:', e
+                ok = False
+            if not ok:
+                # avoid spinning on a dead device
+                time.sleep(.01)
+                continue
+            grabTime = time.time()
+            if self.lastGrab is not None:
+                self.frameInterval += .1 * (grabTime - self.lastGrab - self.frameInterval)
+            self.lastGrab = grabTime
+            with self.lock:
+                self.seq += 1
+                self.captured += 1
+                seq = self.seq
+            if grabTime < self.wantAt:
+                continue
+            try:
+                ok, frame = self.cap.retrieve()
+            except Exception, e:
+                print 'error decoding frame:', e
+                ok = False
+            if not ok or frame is None:
+                continue
+            self.decoded += 1
+            with self.lock:
+                self.ring.append((seq, grabTime, frame))
+            self.newFrame.set()
+            if self.onFrame is not None:
+                self.onFrame()
+    
+    def latest(self, timeout = 0):
+        '''return the newest decoded frame without blocking
+        timeout - seconds to wait if no frame has ever been decoded
+        returns the previous frame if nothing new was decoded, None if no frame is available'''
+        frame = FrameGrabber.latest(self, timeout)
+        # until expect() says otherwise, decode the next frame grabbed
+        self.wantAt = time.time()
+        return frame
+    
+    def stats(self):
+        '''FrameGrabber.stats plus the number of frames decoded'''
+        stats = FrameGrabber.stats(self)
+        stats['decoded'] = self.decoded
+        return stats
+
+
+class FrameSource:
+    '''base class for replayable frame sources that stand in for a cv2.VideoCapture
+    subclasses implement nextFrame() and rewind()'''
+    def __init__(self, fps = 30.0, realTime = False, loop = True):
+        '''fps - nominal frame rate of the source
+        realTime - pace frames to fps; otherwise deliver them as fast as possible (max speed)
+        loop - start again from the first frame at the end of the source
+        delivered - number of frames delivered since pacing started'''
+        self.fps = float(fps)
+        self.realTime = realTime
+        self.loop = loop
+        self.startTime = None
+        self.delivered = 0
+        self.pending = None
+    
+    def nextFrame(self):
+        '''return the next frame or None at the end of the source'''
+        raise NotImplementedError
+    
+    def rewind(self):
+        '''go back to the first frame'''
+        raise NotImplementedError
+    
+    def pace(self):
+        '''in real time mode sleep until the next frame is due'''
+        if not self.realTime:
+            return
+        if self.startTime is None:
+            self.startTime = time.time()
+        delay = self.startTime + self.delivered / self.fps - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.delivered += 1
+    
+    def grab(self):
+        self.pace()
+        frame = self.nextFrame()
+        if frame is None and self.loop:
+            self.rewind()
+            frame = self.nextFrame()
+        self.pending = frame
+        return frame is not None
+    
+    def retrieve(self):
+        if self.pending is None:
+            return False, None
+        return True, self.pending
+    
+    def read(self):
+        self.grab()
+        return self.retrieve()
+    
+    def isOpened(self):
+        return True
+    
+    def get(self, prop):
+        # 3 = width, 4 = height, 5 = fps
+        if prop == 5:
+            return self.fps
+        if prop in (3, 4) and self.pending is not None:
+            return self.pending.shape[1] if prop == 3 else self.pending.shape[0]
+        return 0
+    
+    def set(self, prop, value):
+        return False
+    
+    def release(self):
+        pass
+
+
+class VideoFileSource(FrameSource):
+    '''replay a video file'''
+    def __init__(self, path, fps = None, realTime = False, loop = True):
+        '''path - video file readable by cv2.VideoCapture
+        fps - pacing rate; defaults to the rate stored in the file'''
+        self.path = path
+        self.cap = cv2.VideoCapture(path)
+        if fps is None:
+            fps = self.cap.get(5) or 30.0
+        FrameSource.__init__(self, fps, realTime, loop)
+    
+    def nextFrame(self):
+        ok, frame = self.cap.read()
+        if not ok:
+            return None
+        return frame
+    
+    def rewind(self):
+        # 1 = CAP_PROP_POS_FRAMES
+        self.cap.set(1, 0)
+    
+    def isOpened(self):
+        return self.cap.isOpened()
+    
+    def release(self):
+        self.cap.release()
+
+
+class ArraySource(FrameSource):
+    '''replay a list of in-memory BGR frames'''
+    def __init__(self, frames, fps = 30.0, realTime = False, loop = True):
+        '''frames - list of numpy.array BGR images'''
+        FrameSource.__init__(self, fps, realTime, loop)
+        self.frames = frames
+        self.position = 0
+    
+    def nextFrame(self):
+        if self.position >= len(self.frames):
+            return None
+        # hand out a copy so nothing downstream can alter the replayed frames
+        frame = self.frames[self.position].copy()
+        self.position += 1
+        return frame
+    
+    def rewind(self):
+        self.position = 0
+    
+    def isOpened(self):
+        return len(self.frames) > 0
+
+
+class StillsSource(ArraySource):
+    '''replay a directory (or list) of still images'''
+    # reference images used while developing the colour ratio
+    defaultPath = './Depricated/pixel_count'
+    extensions = ('.jpg', '.jpeg', '.png', '.bmp')
+    
+    def __init__(self, path = defaultPath, fps = 30.0, realTime = False, loop = True):
+        '''path - directory of stills, or a list of image file names'''
+        if isinstance(path, list):
+            files = path
+        else:
+            files = [os.path.join(path, f) for f in sorted(os.listdir(path))
+                     if os.path.splitext(f)[1].lower() in self.extensions]
+        frames = []
+        for f in files:
+            img = cv2.imread(f)
+            if img is None:
+                print 'could not read still:', f
+            else:
+                frames.append(img)
+        self.files = files
+        ArraySource.__init__(self, frames, fps, realTime, loop)
+
             
 class RunTime:
     '''maintain runtime state'''
@@ -393,61 +874,861 @@ class ColorHSV:
         '''dummy function used by openCV trackbars'''
         pass
     
+class BitplaneClassifier:
+    '''classify every channel in one pass over the HSV frame
+    each channel owns one bit of three 256 entry lookup tables (H, S, V); a pixel belongs
+    to a channel when its bit is set in all three tables'''
+    maxChannels = 8
+    # every possible label value, used to turn the label histogram into channel counts
+    labelValues = np.arange(256)
+    # classify() expects an HSV frame
+    usesHSV = True
+    
+    def __init__(self):
+        '''lut - (1, 256, 3) table for cv2.LUT; plane n holds the bits for H, S or V
+        bits - dictionary name: channel bit
+        signature - channel names and thresholds the tables were built from
+        tables - per-pixel lookup results (reused between frames)
+        labels - per-pixel channel bits (reused between frames)
+        selectors - dictionary name: label values that carry the channel's bit
+        labelHist - (256, 1) label histogram (reused between frames)'''
+        self.lut = np.zeros((1, 256, 3), np.uint8)
+        self.bits = {}
+        self.selectors = {}
+        self.signature = None
+        self.tables = None
+        self.labels = None
+        self.labelHist = np.zeros((256, 1), np.float32)
+    
+    def setBits(self, bits):
+        '''record the channel bits and the label values that carry each one'''
+        self.bits = bits
+        self.selectors = {}
+        for name in bits:
+            self.selectors[name] = np.flatnonzero(self.labelValues & bits[name])
+    
+    def update(self, channels):
+        '''rebuild the lookup tables if any channel's thresholds have changed'''
+        signature = [(color.name, tuple(color.lower), tuple(color.upper)) for color in channels]
+        if signature == self.signature:
+            return False
+        if len(channels) > self.maxChannels:
+            raise InputError(str(len(channels)) + ' channels (max ' + str(self.maxChannels) + ')')
+        lut = np.zeros((1, 256, 3), np.uint8)
+        bits = {}
+        for i, color in enumerate(channels):
+            bit = 1 << i
+            for axis in range(0, 3):
+                inside = (self.labelValues >= color.lower[axis]) & (self.labelValues <= color.upper[axis])
+                lut[0, inside, axis] |= bit
+            bits[color.name] = bit
+        self.lut = lut
+        self.setBits(bits)
+        self.signature = signature
+        return True
+    
+    def classify(self, hsvFrame, regionMask = None):
+        '''label every pixel and return dictionary name: pixel count
+        regionMask - optional uint8 mask; pixels where it is 0 are not counted'''
+        if self.labels is None or self.labels.shape != hsvFrame.shape[:2]:
+            self.tables = np.empty(hsvFrame.shape, np.uint8)
+            self.labels = np.empty(hsvFrame.shape[:2], np.uint8)
+        cv2.LUT(hsvFrame, self.lut, dst = self.tables)
+        np.bitwise_and(self.tables[:, :, 0], self.tables[:, :, 1], out = self.labels)
+        np.bitwise_and(self.labels, self.tables[:, :, 2], out = self.labels)
+        return self.countLabels(regionMask)
+    
+    def countLabels(self, regionMask = None):
+        '''return dictionary name: pixel count from the label image'''
+        if regionMask is not None:
+            cv2.bitwise_and(self.labels, regionMask, dst = self.labels)
+        cv2.calcHist([self.labels], [0], None, [256], [0, 256], hist = self.labelHist)
+        counts = {}
+        for name in self.bits:
+            # float64 sum: float32 bins are exact, their sum might not be
+            counts[name] = int(self.labelHist[self.selectors[name]].sum(dtype = np.float64))
+        return counts
+    
+    def mask(self, name, dst = None):
+        '''mask for one channel from the last classify(); non-zero where the channel matched'''
+        return np.bitwise_and(self.labels, self.bits[name], out = dst)
+
+
+class BGRCubeClassifier(BitplaneClassifier):
+    '''classify channels straight from BGR with a quantised colour cube; no HSV conversion
+    each cube cell holds the channel bits of the HSV colour at its centre, so counts are an
+    approximation of the inRange path (see cubeDivergence)'''
+    usesHSV = False
+    
+    def __init__(self, bits = 6):
+        '''bits - bits kept per B, G and R axis (5 = 32x32x32 cube, 6 = 64x64x64)
+        cube - flat uint8 array of channel bits indexed by (b, g, r) cell
+        index, scratch - per-pixel cube index buffers (reused between frames)'''
+        BitplaneClassifier.__init__(self)
+        self.bitsPerAxis = bits
+        self.cube = None
+        self.index = None
+        self.scratch = None
+    
+    def update(self, channels):
+        '''rebuild the cube if any channel's thresholds have changed'''
+        signature = [(color.name, tuple(color.lower), tuple(color.upper)) for color in channels]
+        if signature == self.signature:
+            return False
+        if len(channels) > self.maxChannels:
+            raise InputError(str(len(channels)) + ' channels (max ' + str(self.maxChannels) + ')')
+        levels = 1 << self.bitsPerAxis
+        step = 256 >> self.bitsPerAxis
+        centres = (np.arange(levels) * step + step // 2).astype(np.uint8)
+        b, g, r = np.meshgrid(centres, centres, centres, indexing = 'ij')
+        bgr = np.dstack((b.ravel(), g.ravel(), r.ravel())).reshape(1, -1, 3)
+        hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV).reshape(-1, 3)
+        cube = np.zeros(levels ** 3, np.uint8)
+        bits = {}
+        for i, color in enumerate(channels):
+            bit = 1 << i
+            inside = np.all((hsv >= np.array(color.lower)) & (hsv <= np.array(color.upper)), axis = 1)
+            cube[inside] |= bit
+            bits[color.name] = bit
+        self.cube = cube
+        self.setBits(bits)
+        self.signature = signature
+        return True
+    
+    def classify(self, bgrFrame, regionMask = None):
+        '''label every pixel of a BGR frame and return dictionary name: pixel count'''
+        shape = bgrFrame.shape[:2]
+        if self.labels is None or self.labels.shape != shape:
+            self.index = np.empty(shape, np.int32)
+            self.scratch = np.empty(shape, np.int32)
+            self.labels = np.empty(shape, np.uint8)
+        shift = 8 - self.bitsPerAxis
+        # index = b << 2n | g << n | r with every axis reduced to n bits
+        np.right_shift(bgrFrame[:, :, 0], shift, out = self.index)
+        np.left_shift(self.index, 2 * self.bitsPerAxis, out = self.index)
+        np.right_shift(bgrFrame[:, :, 1], shift, out = self.scratch)
+        np.left_shift(self.scratch, self.bitsPerAxis, out = self.scratch)
+        np.bitwise_or(self.index, self.scratch, out = self.index)
+        np.right_shift(bgrFrame[:, :, 2], shift, out = self.scratch)
+        np.bitwise_or(self.index, self.scratch, out = self.index)
+        np.take(self.cube, self.index, out = self.labels)
+        return self.countLabels(regionMask)
+
+
+class HSVHistogram:
+    '''count-only engine: one quantised 3D HSV histogram per frame turned into a summed
+    volume table, so the pixel count of any lower/upper box is an eight term lookup
+    thresholds are rounded out to whole bins (exact when bins are 1 wide), so it suits preset
+    and preview counts; main() only counts the game ratio with it when histogramCounts is set'''
+    def __init__(self, bins = (180, 32, 32)):
+        '''bins - number of histogram bins for H (0-179), S (0-255) and V (0-255)
+        svt - summed volume table padded with a leading zero plane on every axis
+        lut - (1, 256, 3) uint16 table mapping H, S and V to bin indexes, with S and V laid
+              out so their sum is one combined S*V bin index
+        hist - (H bins, S*V bins) histogram; calcHist only writes into a 2D output in place
+        binned, svBins - per-pixel bin index buffers (reused between frames)'''
+        self.bins = bins
+        self.binWidth = (180.0 / bins[0], 256.0 / bins[1], 256.0 / bins[2])
+        self.svt = np.zeros((bins[0] + 1, bins[1] + 1, bins[2] + 1), np.int64)
+        values = np.arange(256)
+        self.lut = np.zeros((1, 256, 3), np.uint16)
+        self.lut[0, :, 0] = np.minimum(values * bins[0] // 180, bins[0] - 1)
+        self.lut[0, :, 1] = values * bins[1] // 256 * bins[2]
+        self.lut[0, :, 2] = values * bins[2] // 256
+        self.hist = np.zeros((bins[0], bins[1] * bins[2]), np.float32)
+        self.binned = None
+        self.svBins = None
+    
+    def compute(self, hsvFrame, regionMask = None):
+        '''histogram hsvFrame and rebuild the summed volume table
+        regionMask - optional uint8 mask; pixels where it is 0 are not counted'''
+        shape = hsvFrame.shape[:2]
+        if self.binned is None or self.binned.shape[:2] != shape:
+            self.binned = np.empty(shape + (3,), np.uint16)
+            self.svBins = np.empty(shape, np.uint16)
+        cv2.LUT(hsvFrame, self.lut, dst = self.binned)
+        np.add(self.binned[:, :, 1], self.binned[:, :, 2], out = self.svBins)
+        cv2.calcHist([self.binned, self.svBins], [0, 3], regionMask, list(self.hist.shape),
+                     [0, self.hist.shape[0], 0, self.hist.shape[1]], hist = self.hist)
+        inner = self.svt[1:, 1:, 1:]
+        inner[:] = self.hist.reshape(self.bins)
+        np.cumsum(inner, axis = 0, out = inner)
+        np.cumsum(inner, axis = 1, out = inner)
+        np.cumsum(inner, axis = 2, out = inner)
+    
+    def binRange(self, lower, upper, axis):
+        '''(first, last + 1) bin indexes covering lower..upper on one axis'''
+        lo = int(lower / self.binWidth[axis])
+        hi = int(upper / self.binWidth[axis]) + 1
+        return max(0, lo), min(self.bins[axis], hi)
+    
+    def count(self, lower, upper):
+        '''number of pixels inside the HSV box lower..upper (inclusive)'''
+        h0, h1 = self.binRange(lower[0], upper[0], 0)
+        s0, s1 = self.binRange(lower[1], upper[1], 1)
+        v0, v1 = self.binRange(lower[2], upper[2], 2)
+        if h0 >= h1 or s0 >= s1 or v0 >= v1:
+            return 0
+        t = self.svt
+        return int(t[h1, s1, v1] - t[h0, s1, v1] - t[h1, s0, v1] - t[h1, s1, v0]
+                   + t[h0, s0, v1] + t[h0, s1, v0] + t[h1, s0, v0] - t[h0, s0, v0])
+    
+    def presetCounts(self, color):
+        '''count for every defaultRanges preset using color's saturation and value limits
+        returns dictionary preset name: count'''
+        counts = {}
+        for hueLow, hueHigh, presetName in color.defaultRanges:
+            counts[presetName] = self.count([hueLow, color.lower[1], color.lower[2]],
+                                            [hueHigh, color.upper[1], color.upper[2]])
+        return counts
+
+
+class BandClassifier:
+    '''classify horizontal bands of the HSV frame in parallel on a persistent thread pool
+    OpenCV releases the GIL inside inRange and countNonZero, so bands run on separate cores'''
+    usesHSV = True
+    
+    def __init__(self, threads = None):
+        '''threads - pool size; defaults to the number of cores
+        settings - list of (name, lower, upper) from the last update()
+        masks - dictionary name: full frame mask written band by band (reused between frames)'''
+        if threads is None:
+            threads = multiprocessing.cpu_count()
+        self.threads = threads
+        self.pool = multiprocessing.pool.ThreadPool(threads)
+        self.settings = []
+        self.masks = {}
+    
+    def update(self, channels):
+        '''record the current channel thresholds'''
+        self.settings = [(color.name, color.lower, color.upper) for color in channels]
+        return True
+    
+    def classifyBand(self, args):
+        '''mask and count one band; returns dictionary name: count'''
+        hsvFrame, regionMask, y0, y1 = args
+        band = hsvFrame[y0:y1]
+        counts = {}
+        for name, lower, upper in self.settings:
+            # row slices of a contiguous mask are contiguous, so inRange writes in place
+            mask = cv2.inRange(band, lower, upper, dst = self.masks[name][y0:y1])
+            if regionMask is not None:
+                cv2.bitwise_and(mask, regionMask[y0:y1], dst = mask)
+            counts[name] = cv2.countNonZero(mask)
+        return counts
+    
+    def classify(self, hsvFrame, regionMask = None):
+        '''label every pixel and return dictionary name: pixel count'''
+        height = hsvFrame.shape[0]
+        for name, lower, upper in self.settings:
+            if name not in self.masks or self.masks[name].shape != hsvFrame.shape[:2]:
+                self.masks[name] = np.empty(hsvFrame.shape[:2], np.uint8)
+        edges = [height * i // self.threads for i in range(0, self.threads + 1)]
+        jobs = [(hsvFrame, regionMask, edges[i], edges[i + 1]) for i in range(0, self.threads)
+                if edges[i] < edges[i + 1]]
+        counts = {}
+        for name, lower, upper in self.settings:
+            counts[name] = 0
+        for bandCounts in self.pool.map(self.classifyBand, jobs):
+            for name in bandCounts:
+                counts[name] += bandCounts[name]
+        return counts
+    
+    def mask(self, name, dst = None):
+        '''mask for one channel from the last classify(); the classifier's own buffer'''
+        return self.masks[name]
+    
+    def close(self):
+        '''shut down the thread pool'''
+        self.pool.close()
+        self.pool.join()
+
+
+class TileClassifier:
+    '''keep per-tile channel counts and only reclassify tiles that changed since the last frame
+    each tile is averaged down to 4x4 cells; a tile is dirty when any cell's mean H, S or V
+    moved by more than threshold. Every refreshEvery frames, and whenever the region mask
+    changes, all tiles are reclassified'''
+    usesHSV = True
+    
+    def __init__(self, tiles = (8, 8), threshold = 6, refreshEvery = 30):
+        '''tiles - (columns, rows) of the tile grid
+        threshold - change in any cell's mean HSV value that marks its tile dirty
+        refreshEvery - frames between full refreshes
+        tileCounts - dictionary name: (rows, columns) array of per-tile counts
+        masks - dictionary name: full frame mask, updated tile by tile
+        regionMask - region mask the tile counts were taken with (RegionMask caches one
+                     array per region version, so a new array means the region changed)
+        lastDirty - fraction of tiles reclassified on the last frame'''
+        self.tiles = tiles
+        self.threshold = threshold
+        self.refreshEvery = refreshEvery
+        self.settings = []
+        self.signature = None
+        self.tileCounts = {}
+        self.masks = {}
+        self.thumb = None
+        self.shape = None
+        self.frameCount = 0
+        self.regionMask = None
+        self.lastDirty = 1.0
+    
+    def update(self, channels):
+        '''record the current channel thresholds; a change forces a full refresh'''
+        signature = [(color.name, tuple(color.lower), tuple(color.upper)) for color in channels]
+        if signature == self.signature:
+            return False
+        self.settings = [(color.name, color.lower, color.upper) for color in channels]
+        self.signature = signature
+        self.shape = None
+        return True
+    
+    def classify(self, hsvFrame, regionMask = None):
+        '''reclassify dirty tiles and return dictionary name: pixel count'''
+        height, width = hsvFrame.shape[:2]
+        columns, rows = self.tiles
+        # 4x4 cell means for every tile; INTER_AREA averages over the tile grid below
+        thumb = cv2.resize(hsvFrame, (columns * 4, rows * 4), interpolation = cv2.INTER_AREA)
+        full = self.shape != (height, width) or self.frameCount % self.refreshEvery == 0
+        # clean tiles still hold counts taken with the old region
+        full = full or regionMask is not self.regionMask
+        if full:
+            self.shape = (height, width)
+            self.regionMask = regionMask
+            dirty = np.ones((rows, columns), np.bool_)
+            for name, lower, upper in self.settings:
+                self.tileCounts[name] = np.zeros((rows, columns), np.int64)
+                self.masks[name] = np.zeros((height, width), np.uint8)
+        else:
+            change = cv2.absdiff(thumb, self.thumb).max(axis = 2)
+            dirty = change.reshape(rows, 4, columns, 4).max(axis = 3).max(axis = 1) > self.threshold
+        self.thumb = thumb
+        self.frameCount += 1
+        
+        xs = [width * i // columns for i in range(0, columns + 1)]
+        ys = [height * i // rows for i in range(0, rows + 1)]
+        for ty, tx in np.argwhere(dirty):
+            y0, y1, x0, x1 = ys[ty], ys[ty + 1], xs[tx], xs[tx + 1]
+            tile = hsvFrame[y0:y1, x0:x1]
+            for name, lower, upper in self.settings:
+                mask = cv2.inRange(tile, lower, upper)
+                if regionMask is not None:
+                    cv2.bitwise_and(mask, regionMask[y0:y1, x0:x1], dst = mask)
+                self.masks[name][y0:y1, x0:x1] = mask
+                self.tileCounts[name][ty, tx] = cv2.countNonZero(mask)
+        self.lastDirty = dirty.sum() / float(rows * columns)
+        
+        counts = {}
+        for name, lower, upper in self.settings:
+            counts[name] = int(self.tileCounts[name].sum())
+        return counts
+    
+    def mask(self, name, dst = None):
+        '''mask for one channel as of the last classify(); the classifier's own buffer'''
+        return self.masks[name]
+
+
+class VoteGrid:
+    '''per-cell channel counts on a columns x rows grid over the masks
+    counts come from one integral image per channel, so the cost hardly depends on grid size'''
+    def __init__(self, columns = 4, rows = 3):
+        '''counts - dictionary name: (rows, columns) array of pixel counts
+        ratios - (rows, columns) array of ratio() per cell
+        binary, integral - 0/1 mask and its integral image (reused between frames)'''
+        self.columns = columns
+        self.rows = rows
+        self.counts = {}
+        self.ratios = np.zeros((rows, columns))
+        self.binary = None
+        self.integral = None
+    
+    def cellCounts(self, mask):
+        '''count non-zero mask pixels in every grid cell'''
+        height, width = mask.shape[:2]
+        if self.binary is None or self.binary.shape != (height, width):
+            self.binary = np.empty((height, width), np.uint8)
+            self.integral = np.empty((height + 1, width + 1), np.int32)
+        cv2.threshold(mask, 0, 1, cv2.THRESH_BINARY, dst = self.binary)
+        integral = cv2.integral(self.binary, sum = self.integral, sdepth = cv2.CV_32S)
+        ys = [height * i // self.rows for i in range(0, self.rows + 1)]
+        xs = [width * i // self.columns for i in range(0, self.columns + 1)]
+        corners = integral[np.ix_(ys, xs)]
+        return corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+    
+    def compute(self, masks, nameA, nameB):
+        '''update counts and per-cell ratios from the two channel masks
+        masks cover cvFrame.maskBox when a region is set, so the grid spans that box'''
+        self.counts = {nameA: self.cellCounts(masks[nameA]), nameB: self.cellCounts(masks[nameB])}
+        for y in range(0, self.rows):
+            for x in range(0, self.columns):
+                self.ratios[y, x] = ratio(self.counts[nameA][y, x], self.counts[nameB][y, x])
+        return self.ratios
+    
+    def message(self):
+        '''compact text message: #GRID: <columns>x<rows>: row by row ratios#'''
+        cells = ','.join(['%.2f' % r for r in self.ratios.ravel()])
+        return '#GRID: ' + str(self.columns) + 'x' + str(self.rows) + ': ' + cells + '#'
+
+
+class RatioEstimator:
+    '''estimate ratio() from a strided pixel sample of the frame
+    starts with the widest stride that keeps at least minWidth samples per row and halves it
+    only while the confidence interval straddles a dead-band edge of ratio()
+    the sample grid starts at a random offset each frame so no pixels are always skipped'''
+    def __init__(self, minWidth = 64, z = 1.96, deadBand = .2):
+        '''minWidth - samples per row at the widest stride
+        z - confidence interval width in standard deviations
+        deadBand - ratio() snaps values inside +/- deadBand to 0.0
+        last - (ratio, low, high, stride, pixels) from the last estimate'''
+        self.minWidth = minWidth
+        self.z = z
+        self.deadBand = deadBand
+        self.last = None
+    
+    def straddles(self, low, high):
+        '''True if a dead-band edge lies inside low..high, so the command is still uncertain'''
+        for edge in (-self.deadBand, self.deadBand):
+            if low < edge < high:
+                return True
+        return False
+    
+    def estimate(self, frame, colorA, colorB, region = None):
+        '''return ratio() of colorA to colorB estimated from the BGR frame
+        frame - the analysis frame (cvFrame.frame), never one with overlays drawn on it
+        region - optional RegionMask limiting the sampled pixels'''
+        regionMask = None
+        if region is not None:
+            (x0, y0, x1, y1), regionMask = region.rasterise(frame.shape[0], frame.shape[1])
+            frame = frame[y0:y1, x0:x1]
+        stride = 1
+        while frame.shape[1] // (stride * 2) >= self.minWidth:
+            stride *= 2
+        while True:
+            ox, oy = np.random.randint(0, stride, 2)
+            sample = np.ascontiguousarray(frame[oy::stride, ox::stride])
+            hsvFrame = cv2.cvtColor(sample, cv2.COLOR_BGR2HSV)
+            maskA = cv2.inRange(hsvFrame, colorA.lower, colorA.upper)
+            maskB = cv2.inRange(hsvFrame, colorB.lower, colorB.upper)
+            if regionMask is not None:
+                sampleMask = np.ascontiguousarray(regionMask[oy::stride, ox::stride])
+                maskA = cv2.bitwise_and(maskA, sampleMask)
+                maskB = cv2.bitwise_and(maskB, sampleMask)
+            countA, countB = cv2.countNonZero(maskA), cv2.countNonZero(maskB)
+            value, low, high = ratioInterval(countA, countB, self.z)
+            if stride == 1 or not self.straddles(low, high):
+                break
+            stride //= 2
+        self.last = (ratio(countA, countB), low, high, stride, sample.shape[0] * sample.shape[1])
+        return self.last[0]
+
+
+class RegionMask:
+    '''region of interest and exclusion polygons for the classifier
+    polygons are stored in normalised (0-1) coordinates so they survive frame size changes'''
+    def __init__(self, roi = [], exclude = []):
+        '''roi - list of polygons to classify; an empty list means the whole frame
+        exclude - list of polygons to ignore (stage, ceiling, scoreboard, etc.)
+        pending - vertices of the polygon currently being drawn
+        version - incremented whenever the polygons change
+        cache - dictionary (height, width): (box, mask) for the current version'''
+        self.roi = [list(p) for p in roi]
+        self.exclude = [list(p) for p in exclude]
+        self.pending = []
+        self.version = 0
+        self.cache = {}
+        self.cacheVersion = None
+        self.frameShape = None
+    
+    def setPolygons(self, roi, exclude):
+        '''replace all polygons (used when loading saved channel settings)'''
+        self.roi = [list(p) for p in roi]
+        self.exclude = [list(p) for p in exclude]
+        self.pending = []
+        self.version += 1
+    
+    def polygons(self):
+        '''return (roi, exclude) for saving'''
+        return (self.roi, self.exclude)
+    
+    def isEmpty(self):
+        return len(self.roi) == 0 and len(self.exclude) == 0
+    
+    def toPixels(self, polygon, height, width):
+        '''scale a normalised polygon to an int32 point array for cv2.fillPoly'''
+        return np.array([[int(round(x * (width - 1))), int(round(y * (height - 1)))]
+                         for x, y in polygon], np.int32)
+    
+    def rasterise(self, height, width):
+        '''return (box, mask) for a frame size
+        box - (x0, y0, x1, y1) bounding box of the region of interest
+        mask - uint8 array the size of box, 255 where pixels should be classified;
+               None when every pixel in the box counts
+        recalculated only when the polygons or the frame size change'''
+        if self.cacheVersion != self.version:
+            self.cache = {}
+            self.cacheVersion = self.version
+        if (height, width) in self.cache:
+            return self.cache[(height, width)]
+        if self.isEmpty():
+            box, mask = (0, 0, width, height), None
+        else:
+            full = np.zeros((height, width), np.uint8)
+            if len(self.roi) > 0:
+                cv2.fillPoly(full, [self.toPixels(p, height, width) for p in self.roi], 255)
+            else:
+                full[:] = 255
+            if len(self.exclude) > 0:
+                cv2.fillPoly(full, [self.toPixels(p, height, width) for p in self.exclude], 0)
+            x, y, w, h = cv2.boundingRect(cv2.findNonZero(full)) if cv2.countNonZero(full) else (0, 0, 1, 1)
+            box = (x, y, x + w, y + h)
+            mask = full[y:y + h, x:x + w].copy()
+        self.cache[(height, width)] = (box, mask)
+        return box, mask
+    
+    def mouseEvent(self, event, x, y, flags, param):
+        '''HighGUI mouse callback: left click adds a vertex to the pending polygon'''
+        if event == cv2.EVENT_LBUTTONDOWN and self.frameShape is not None:
+            height, width = self.frameShape
+            self.pending.append((x / float(width - 1), y / float(height - 1)))
+    
+    def closeROI(self):
+        '''finish the pending polygon as a region of interest'''
+        if len(self.pending) < 3:
+            return (-3, 'click at least 3 points on the live window first')
+        self.roi.append(self.pending)
+        self.pending = []
+        self.version += 1
+        return (-3, 'added region of interest')
+    
+    def closeExclusion(self):
+        '''finish the pending polygon as an excluded region'''
+        if len(self.pending) < 3:
+            return (-3, 'click at least 3 points on the live window first')
+        self.exclude.append(self.pending)
+        self.pending = []
+        self.version += 1
+        return (-3, 'added excluded region')
+    
+    def clear(self):
+        '''remove all regions'''
+        self.setPolygons([], [])
+        return (-3, 'cleared regions')
+    
+    def draw(self, img):
+        '''outline roi (green), exclusions (red) and the pending polygon (white) on img'''
+        height, width = img.shape[:2]
+        self.frameShape = (height, width)
+        for polys, color in ((self.roi, (0, 255, 0)), (self.exclude, (0, 0, 255))):
+            if len(polys) > 0:
+                cv2.polylines(img, [self.toPixels(p, height, width) for p in polys], True, color, 2)
+        if len(self.pending) > 0:
+            cv2.polylines(img, [self.toPixels(self.pending, height, width)], False, (255, 255, 255), 1)
+        return img
+
+
 class cvFrame:
     '''OpenCV frame object'''
     
-    def __init__(self, videoDev = 0, frameWidth = 500, name = 'Live'):
+    # capture modes to try when negotiating: resolutions, frame rates and pixel formats
+    # YUYV is listed first: at equal size it needs no decode, MJPG trades decode for bandwidth
+    modeSizes = [(320, 240), (424, 240), (640, 360), (640, 480), (800, 600),
+                 (960, 540), (1280, 720), (1920, 1080)]
+    modeFPS = [30, 60]
+    modeFourcc = ['YUYV', 'MJPG']
+    
+    def __init__(self, videoDev = 0, frameWidth = 500, name = 'Live', threaded = False,
+                 preallocate = False, camCache = './cameras.pick', fps = None, lazyDecode = False):
         '''name - human readable name
         cap - video capture object
-        frame - single frame from video stream
+        grabber - background FrameGrabber thread (None when threaded is False)
+        lazyDecode - grabber only decodes frames that readFrame asks for (LazyGrabber)
+        onFrame - optional callable the grabber runs for every new frame (see setOnFrame)
+        preallocate - reuse intermediate buffers instead of allocating new arrays every frame
+        buffers - dictionary of preallocated buffers for the current frame geometry
+        rawFrame - last unresized frame read from the capture device
+        captureTime - time rawFrame was captured (time read without a capture thread)
+        region - optional RegionMask limiting which pixels are classified
+        classifier - optional single pass classifier used by classifyAll (BitplaneClassifier)
+        histogram - optional count-only HSVHistogram used by classifyAll when no masks are needed
+        timer - optional StageTimer recording hot-path stage durations (None costs nothing)
+        generation - incremented for every new frame processed
+        stamps - dictionary stage: inputs the stage was last computed from (see needsUpdate)
+        maskBox - (x0, y0, x1, y1) area of the frame covered by the masks
+        pixelCount - number of pixels the last classification covered (see regionCrop)
+        frame - single frame from video stream; the analysis frame every classifier reads,
+                never drawn on (overlays go on displayFrame())
         frameWidth - width of sampled frame in pixles 
         mask - dictionary key: numpy.array image
         nonZero - dictionary key: sum of non-zero pixels
         result - dictionary key: bitwise and of mask and frame
-        videoDev - current video device
+        videoDev - current video device index or a FrameSource to replay
+        camCache - CameraCache of previously probed devices
+        camInfo - dictionary index: (index, width, height, fps, modes) of known devices
+        fps - frame rate to negotiate with the device (None leaves the device default)
+        captureMode - (width, height, fps, fourcc) selected by negotiateMode
         connectedCams - list of connected and readable cameras
         cameraPointer = pointer to currently active camera'''
         self.name = name
         self.frameWidth = frameWidth
-        self.cap = cv2.VideoCapture(videoDev)
+        if isinstance(videoDev, FrameSource):
+            self.cap = videoDev
+        else:
+            self.cap = cv2.VideoCapture(videoDev)
+        self.grabber = None
+        self.lazyDecode = lazyDecode
+        self.onFrame = None
+        if threaded:
+            self.startGrabber()
+        self.preallocate = preallocate
+        self.buffers = {}
+        self.rawFrame = None
+        self.captureTime = None
+        self.region = None
+        self.maskBox = None
+        self.pixelCount = 0
+        self.classifier = None
+        self.histogram = None
+        self.timer = None
+        self.generation = 0
+        self.stamps = {}
         self.hsvFrame = None
+        self.frame = None
         self.frame = self.readFrame()
+        startTime = time.time()
+        while self.frame is None and self.grabber is not None and time.time() - startTime < 30:
+            # slow starting cameras can take several seconds to deliver their first frame
+            self.frame = self.readFrame()
         self.mask = {}
         self.nonZero = {}
         self.result = {}
         self.videoDev = videoDev
-        self.connectedCams = self.checkCams()
+        self.camCache = CameraCache(camCache)
+        self.camInfo = {}
+        if isinstance(videoDev, FrameSource):
+            # replaying a recording; there are no devices to enumerate
+            self.connectedCams = []
+        else:
+            self.connectedCams = self.findCams()
         self.cameraPointer = 0
+        if self.videoDev in self.connectedCams:
+            self.cameraPointer = self.connectedCams.index(self.videoDev)
+        self.fps = fps
+        self.captureMode = None
+        if self.fps is not None and not isinstance(videoDev, FrameSource):
+            self.negotiateMode()
         
     
+    def findCams(self):
+        '''use the device cache when the current device is in it and still readable
+        otherwise sweep all devices and rebuild the cache'''
+        cached = self.camCache.loadCams()
+        # the current device has already been opened and read by readFrame
+        if self.videoDev in cached and self.cap.isOpened() and self.rawFrame is not None:
+            self.camInfo = cached
+            return sorted(cached.keys())
+        return self.checkCams()
+    
     def checkCams(self):
-        '''enumerate the connected and readable video devices'''
-        cameraList = []
-        for i in range(0, 10):
-            try:
-                connected, _ = cv2.VideoCapture(i).read()
-            except Excpetion, e:
-                print 'video device', i, 'not avaialble - this is OK!'
-            cv2.VideoCapture(i).release()
-            if connected:
-                cameraList.append(i)
-        return cameraList
+        '''enumerate the connected and readable video devices and save them to the cache
+        the device this object is streaming from is described from self.cap rather than
+        opened a second time, which most V4L2 drivers refuse while it is streaming'''
+        indexes = range(0, 10)
+        current = None
+        if not isinstance(self.videoDev, FrameSource) and self.cap.isOpened() \
+                and self.rawFrame is not None:
+            current = dict(self.camInfo.get(self.videoDev, {}))
+            # 5 = CAP_PROP_FPS
+            current.update({'index': self.videoDev, 'width': self.rawFrame.shape[1],
+                            'height': self.rawFrame.shape[0], 'fps': self.cap.get(5)})
+            indexes = [i for i in indexes if i != self.videoDev]
+        self.camInfo = probeCams(indexes)
+        if current is not None:
+            self.camInfo[self.videoDev] = current
+        self.camCache.saveCams(self.camInfo)
+        return sorted(self.camInfo.keys())
+    
+    
+    def probeModes(self):
+        '''try every candidate capture mode on the open device
+        returns a list of (width, height, fps, fourcc) tuples the device actually delivers'''
+        accepted = []
+        for code in self.modeFourcc:
+            for width, height in self.modeSizes:
+                for fps in self.modeFPS:
+                    self.cap.set(6, fourcc(code))
+                    self.cap.set(3, width)
+                    self.cap.set(4, height)
+                    self.cap.set(5, fps)
+                    if (int(self.cap.get(3)), int(self.cap.get(4))) != (width, height):
+                        continue
+                    if int(self.cap.get(6)) != fourcc(code) or self.cap.get(5) < fps:
+                        continue
+                    # some backends accept a setting without honouring it; check a real frame
+                    ok, frame = self.cap.read()
+                    if ok and frame is not None and frame.shape[:2] == (height, width):
+                        accepted.append((width, height, fps, code))
+        return accepted
     
+    def negotiateMode(self):
+        '''ask the device for the cheapest mode that covers frameWidth at self.fps
+        modes are probed once per device and stored in the camera cache; the device (and
+        capture thread) is only touched when the selected mode changes'''
+        threaded = self.grabber is not None
+        info = self.camInfo.setdefault(self.videoDev, {'index': self.videoDev})
+        if 'modes' not in info:
+            self.stopGrabber()
+            info['modes'] = self.probeModes()
+            self.camCache.saveCams(self.camInfo)
+        # fewest pixels wins; on a tie the earlier (uncompressed) fourcc wins
+        candidates = [m for m in info['modes'] if m[0] >= self.frameWidth and m[2] >= self.fps]
+        candidates.sort(key = lambda m: (m[0] * m[1], m[2], self.modeFourcc.index(m[3])))
+        if len(candidates) == 0:
+            self.captureMode = None
+        elif candidates[0] != self.captureMode:
+            self.stopGrabber()
+            width, height, fps, code = candidates[0]
+            self.cap.set(6, fourcc(code))
+            self.cap.set(3, width)
+            self.cap.set(4, height)
+            self.cap.set(5, fps)
+            self.captureMode = candidates[0]
+        if threaded and self.grabber is None:
+            self.startGrabber()
+        return (-3, 'capture mode: ' + str(self.captureMode))
     
     def changeVideo(self):
         '''cycle through available video devices'''
         numCameras = len(self.connectedCams)
+        if numCameras == 0:
+            return (-3, 'no video devices found')
         self.cameraPointer += 1
         if self.cameraPointer > numCameras -1:
             self.cameraPointer = 0
         self.videoDev = self.connectedCams[self.cameraPointer]
+        threaded = self.grabber is not None
+        self.stopGrabber()
         self.cap = cv2.VideoCapture(self.videoDev)
+        if not self.cap.isOpened():
+            # the cache is stale; sweep again and fall back to the first readable device
+            self.connectedCams = self.checkCams()
+            self.cameraPointer = 0
+            if len(self.connectedCams) > 0:
+                self.videoDev = self.connectedCams[0]
+                self.cap = cv2.VideoCapture(self.videoDev)
+        if self.fps is not None:
+            self.negotiateMode()
+        if threaded:
+            self.startGrabber()
         return (-3, 'changed video device to ' + str(self.videoDev))
     
+    def startGrabber(self, bufferSize = 2):
+        '''start reading frames from self.cap on a background thread'''
+        # 38 = CAP_PROP_BUFFERSIZE; keep as few frames queued in the driver as the backend allows
+        try:
+            self.cap.set(38, 1)
+        except Exception, e:
+            pass
+        if self.lazyDecode:
+            self.grabber = LazyGrabber(self.cap)
+        else:
+            self.grabber = FrameGrabber(self.cap, bufferSize)
+        self.grabber.onFrame = self.onFrame
+        self.grabber.start()
+    
+    def stopGrabber(self):
+        '''stop the background capture thread if one is running'''
+        if self.grabber is not None:
+            self.grabber.stop()
+            self.grabber = None
+    
+    def frameStats(self, frame, bins = 16):
+        '''cheap statistics for a frame from a 32x24 thumbnail
+        returns (mean luminance, list of normalised per-channel histograms)'''
+        thumb = cv2.resize(frame, (32, 24), interpolation = cv2.INTER_AREA)
+        luma = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY).mean()
+        hists = []
+        for c in range(0, 3):
+            h = cv2.calcHist([thumb], [c], None, [bins], [0, 256])
+            hists.append(h / float(thumb.shape[0] * thumb.shape[1]))
+        return luma, hists
+    
+    def warmUp(self, timeout = 5.0, lumaTol = 1.5, histTol = .05, stableFrames = 5, winName = None,
+               maxFailures = 50):
+        '''read frames until auto exposure/white balance settle or timeout expires
+        the stream is ready when mean luminance moves less than lumaTol and the summed
+        per-channel histogram drift is below histTol for stableFrames consecutive frames
+        winName - optional HighGUI window to show frames in while waiting
+        maxFailures - consecutive failed reads without a capture thread before giving up
+        returns (ready, frames read, seconds taken)'''
+        startTime = time.time()
+        lastLuma, lastHists = None, None
+        stable = 0
+        frames = 0
+        failures = 0
+        while time.time() - startTime < timeout:
+            if self.grabber is not None:
+                # wait for a new frame rather than measuring the same one twice
+                self.grabber.newFrame.wait(max(0, timeout - (time.time() - startTime)))
+            generation = self.generation
+            self.readFrame()
+            if self.generation == generation:
+                # failed read (or nothing newer yet); never measure the last frame twice
+                failures += 1
+                if self.grabber is None and failures >= maxFailures:
+                    break
+                time.sleep(.01)
+                continue
+            failures = 0
+            frames += 1
+            luma, hists = self.frameStats(self.rawFrame)
+            if winName is not None:
+                cv2.imshow(winName, self.frame)
+                cv2.waitKey(1)
+            if lastLuma is not None:
+                drift = sum([np.abs(h - lh).sum() for h, lh in zip(hists, lastHists)])
+                if abs(luma - lastLuma) < lumaTol and drift < histTol:
+                    stable += 1
+                else:
+                    stable = 0
+            lastLuma, lastHists = luma, hists
+            if stable >= stableFrames:
+                return (True, frames, time.time() - startTime)
+        return (False, frames, time.time() - startTime)
+    
+    def expectFrame(self, delay):
+        '''tell the capture thread the next readFrame is due in about delay seconds'''
+        if self.grabber is not None:
+            self.grabber.expect(delay)
+    
+    def setOnFrame(self, callback):
+        '''run callback on the capture thread for every new frame, now and after restarts'''
+        self.onFrame = callback
+        if self.grabber is not None:
+            self.grabber.onFrame = callback
+    
+    def frameEvent(self):
+        '''event set by the capture thread when a new frame is ready; None without a capture thread'''
+        if self.grabber is None:
+            return None
+        return self.grabber.newFrame
+    
+    def captureStats(self):
+        '''report frames captured, dropped and consumed by the capture thread'''
+        if self.grabber is None:
+            return (-3, 'capture thread not running')
+        return (-3, 'capture stats: ' + str(self.grabber.stats()))
+    
+    def setFrameWidth(self, width):
+        '''change the sampled frame width and re-select the capture mode to match
+        the mode is chosen from the cached probe, so this does not probe the device again'''
+        self.frameWidth = width
+        if self.fps is not None and not isinstance(self.videoDev, FrameSource):
+            self.negotiateMode()
+    
     def increaseFrameSize(self):
         '''increase sampled frame size'''
         if self.frameWidth <= 1550:
-            self.frameWidth += 50
+            self.setFrameWidth(self.frameWidth + 50)
         else:
             pass
         return (-3, 'indreased frame size')
@@ -455,24 +1736,50 @@ class cvFrame:
     def decreaseFrameSize(self):
         '''decrease sampled frame size'''
         if self.frameWidth >= 100:
-            self.frameWidth += -50
+            self.setFrameWidth(self.frameWidth - 50)
         else:
             pass
         return (-3, 'decreased frame size')
     
     def resetFrameSize(self):
         '''reset framesize to default'''
-        self.frameWidth = 500
+        self.setFrameWidth(500)
         return (-3, 'reset frame size')
     
     def readFrame(self):
         '''update captured frame capture device'''
-        width = self.frameWidth
+        if self.timer is not None:
+            stageStart = self.timer.clock()
+        tempFrame = None
         try:
-            _, tempFrame = self.cap.read()
+            if self.grabber is not None:
+                # newest frame from the capture thread; never blocks once running
+                tempFrame = self.grabber.latest(timeout = 1.0)
+            else:
+                _, tempFrame = self.cap.read()
         except Exception, e:
             print 'error reading frame:', e
-            
+        if self.timer is not None:
+            self.timer.add('capture', self.timer.clock() - stageStart)
+        if tempFrame is None:
+            # no frame yet (slow starting camera) or the device failed; keep the last one
+            return self.frame
+        if tempFrame is self.rawFrame and self.frame is not None \
+                and self.frame.shape[1] == self.frameWidth:
+            # the capture thread has nothing newer; the derived frames are still current
+            return self.frame
+        self.rawFrame = tempFrame
+        if self.grabber is not None and self.grabber.lastCaptureTime is not None:
+            self.captureTime = self.grabber.lastCaptureTime
+        else:
+            self.captureTime = time.time()
+        return self.processFrame(tempFrame)
+    
+    def processFrame(self, tempFrame):
+        '''resize a raw frame to frameWidth
+        the HSV frame is converted on first use (see ensureHSV)'''
+        self.generation += 1
+        width = self.frameWidth
         try:
             r = float(width) / tempFrame.shape[1]
         except Exception, e:
@@ -480,20 +1787,180 @@ class cvFrame:
             r = 1.0
         
         dim = (int(width), int(tempFrame.shape[0] * r))
-        resizedFrame = cv2.resize(tempFrame, dim, interpolation = cv2.INTER_AREA)
+        if self.timer is not None:
+            stageStart = self.timer.clock()
+        if self.preallocate:
+            self.allocBuffers(dim[1], dim[0])
+        if tempFrame.shape[1] == dim[0]:
+            # the device already delivers the analysis size; nothing to resize
+            resizedFrame = tempFrame
+        elif self.preallocate:
+            resizedFrame = cv2.resize(tempFrame, dim, dst = self.buffers['frame'],
+                                      interpolation = cv2.INTER_AREA)
+        else:
+            resizedFrame = cv2.resize(tempFrame, dim, interpolation = cv2.INTER_AREA)
+        if self.timer is not None:
+            self.timer.add('resize', self.timer.clock() - stageStart)
             
         self.frame = resizedFrame
-        # convert to HSV space immediately 
-        self.cvtHSV()
         return self.frame
     
     def cvtHSV(self):
         '''convert BGR frame to HSV space'''
-        self.hsvFrame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2HSV)
+        self.stamps['hsv'] = self.generation
+        if self.timer is not None:
+            stageStart = self.timer.clock()
+        if self.preallocate:
+            self.hsvFrame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2HSV, dst = self.buffers['hsv'])
+        else:
+            self.hsvFrame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2HSV)
+        if self.timer is not None:
+            self.timer.add('hsv', self.timer.clock() - stageStart)
         return self.hsvFrame
     
+    def ensureHSV(self):
+        '''convert the current frame to HSV unless that has already been done'''
+        if self.stamps.get('hsv') != self.generation:
+            self.cvtHSV()
+        return self.hsvFrame
+    
+    def needsUpdate(self, stage, key):
+        '''return True (and record key) if stage was last computed from different inputs
+        stage - any hashable name, e.g. ('mask', channel name)
+        key - everything the stage depends on, e.g. frame generation and thresholds'''
+        if stage in self.stamps and self.stamps[stage] == key:
+            return False
+        self.stamps[stage] = key
+        return True
+    
+    def regionVersion(self):
+        '''version of the region polygons; None without a region'''
+        if self.region is None:
+            return None
+        return self.region.version
+    
+    def allocBuffers(self, height, width):
+        '''allocate the intermediate buffers for a frame geometry
+        buffers are only reallocated when the geometry changes (see increaseFrameSize)'''
+        if self.buffers.get('shape') == (height, width):
+            return False
+        self.buffers = {'shape': (height, width),
+                        'frame': np.empty((height, width, 3), np.uint8),
+                        'hsv': np.empty((height, width, 3), np.uint8),
+                        'mask': {},
+                        'result': {},
+                        'joined': np.empty((height, width * 2, 3), np.uint8),
+                        'display': np.empty((height, width, 3), np.uint8)}
+        return True
+    
+    def getBuffer(self, kind, name, channels = 1, shape = None):
+        '''return the preallocated buffer of kind ('mask' or 'result') for a channel name
+        creates it on first use at the current geometry, or at shape (height, width) if given'''
+        pool = self.buffers[kind]
+        if shape is None:
+            shape = self.buffers['shape']
+        if name not in pool or pool[name].shape[:2] != tuple(shape):
+            height, width = shape
+            if channels == 1:
+                pool[name] = np.empty((height, width), np.uint8)
+            else:
+                pool[name] = np.empty((height, width, channels), np.uint8)
+        return pool[name]
+    
+    def checkAllocations(self, channels, frames = 50, warmup = 5, voteGrid = None, slack = 4):
+        '''run the steady-state pipeline on the last raw frame and verify it does not allocate
+        every frame is classified twice through classifyAll, the way main() does: once with
+        masks (classifier, results, joined view and voteGrid) and once count-only (histogram)
+        channels - list of ColorHSV objects
+        voteGrid - optional VoteGrid to include
+        slack - pages of one-off interpreter growth tolerated over the whole run
+        returns a dictionary (all None and passed False without preallocate or a frame):
+            reallocated - True if any preallocated buffer was replaced after warm up
+            newPages - pages first touched while running the frames (None if unavailable)
+            peakBytes - tracemalloc peak above the warmed up baseline (None if unavailable);
+                        informational, it includes interpreter scratch such as key tuples
+            passed - True if no buffer was replaced and at most <slack> pages were touched
+        newPages works on python 2.7: glibc is told to mmap every allocation of a page or more,
+        so any such temporary (a resize without dst, an np.concatenate, a calcHist without
+        hist, ...) costs fresh pages on every frame and shows up as minor page faults.
+        Allocations smaller than a page come from the heap without faulting and are not seen;
+        passed only proves that no page-sized temporary is allocated per frame'''
+        if not self.preallocate or self.rawFrame is None:
+            print 'checkAllocations needs preallocate = True and a frame to replay'
+            return {'reallocated': None, 'newPages': None, 'peakBytes': None, 'passed': False}
+        # the capture thread allocates a fresh frame for every read; keep it out of the trace
+        threaded = self.grabber is not None
+        self.stopGrabber()
+        raw = self.rawFrame
+        names = [color.name for color in channels]
+        
+        def step():
+            self.processFrame(raw)
+            self.classifyAll(channels, makeMasks = True)
+            for name in names:
+                self.calcResult(name)
+            if len(names) > 1:
+                self.joinResults(names[0], names[1])
+                if voteGrid is not None:
+                    voteGrid.compute(self.mask, names[0], names[1])
+            # display paused: counts only
+            self.processFrame(raw)
+            self.classifyAll(channels, makeMasks = False)
+        
+        for i in range(0, warmup):
+            step()
+        # record the address of every buffer
+        before = [self.buffers['frame'].ctypes.data, self.buffers['hsv'].ctypes.data]
+        before += [self.buffers['mask'][n].ctypes.data for n in names]
+        before += [self.buffers['result'][n].ctypes.data for n in names]
+        
+        # -3 = M_MMAP_THRESHOLD; setting it also stops glibc from raising it after frees
+        libc = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            if libc.mallopt(-3, mmap.PAGESIZE) != 1:
+                libc = None
+        except Exception, e:
+            libc = None
+        if libc is not None:
+            # let anything allocated before the threshold changed be freed and reused first
+            for i in range(0, warmup):
+                step()
+        peakBytes = None
+        if tracemalloc is not None:
+            tracemalloc.start()
+            baseline, _ = tracemalloc.get_traced_memory()
+        # faults caused by measuring alone
+        idle = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+        idle = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - idle
+        faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+        for i in xrange(0, frames):
+            step()
+        faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults - idle
+        if tracemalloc is not None:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            peakBytes = peak - baseline
+        newPages = None
+        if libc is not None:
+            newPages = max(0, faults)
+            # back to the glibc default (the threshold stays fixed from here on)
+            libc.mallopt(-3, 128 * 1024)
+        
+        after = [self.buffers['frame'].ctypes.data, self.buffers['hsv'].ctypes.data]
+        after += [self.buffers['mask'][n].ctypes.data for n in names]
+        after += [self.buffers['result'][n].ctypes.data for n in names]
+        
+        if threaded:
+            self.startGrabber()
+        reallocated = before != after
+        passed = not reallocated and newPages is not None and newPages <= slack
+        return {'reallocated': reallocated, 'newPages': newPages, 'peakBytes': peakBytes,
+                'passed': passed}
+    
     def release(self):
         '''release any active cameras'''
+        self.stopGrabber()
         for i in self.connectedCams:
             cv2.VideoCapture(i).release
         #self.cap.release()
@@ -504,15 +1971,143 @@ class cvFrame:
         mask - dictionary key(name): numpy.array
                 zero and non-zero pixels that represent masked pixels outside the defined range
         nonZero - dictionary key(name): numpy.array
-                integer sum of non-zero pixels (unmased region)'''
-        self.mask[name] = cv2.inRange(self.hsvFrame, lower, upper)
+                integer sum of non-zero pixels (unmased region)
+        with a region set, masks only cover maskBox and excluded pixels are zeroed
+        nothing is recalculated if the frame, thresholds and region are unchanged'''
+        key = (self.generation, tuple(lower), tuple(upper), self.regionVersion())
+        if name in self.mask and not self.needsUpdate(('mask', name), key):
+            return
+        self.stamps[('mask', name)] = key
+        hsvFrame, regionMask = self.regionCrop(self.ensureHSV())
+        if self.timer is not None:
+            stageStart = self.timer.clock()
+        if self.preallocate:
+            self.mask[name] = cv2.inRange(hsvFrame, lower, upper,
+                                          dst = self.getBuffer('mask', name, shape = hsvFrame.shape[:2]))
+        else:
+            self.mask[name] = cv2.inRange(hsvFrame, lower, upper)
+        if regionMask is not None:
+            cv2.bitwise_and(self.mask[name], regionMask, dst = self.mask[name])
         self.nonZero[name] = cv2.countNonZero(self.mask[name])
+        if self.timer is not None:
+            self.timer.add('mask ' + name, self.timer.clock() - stageStart)
         
     
+    def regionCrop(self, img = None):
+        '''return (pixels of img to classify, region mask or None) and set maskBox and pixelCount
+        img - frame to crop; hsvFrame by default'''
+        if img is None:
+            img = self.hsvFrame
+        self.maskBox = None
+        if self.region is None:
+            self.pixelCount = img.shape[0] * img.shape[1]
+            return img, None
+        height, width = img.shape[:2]
+        self.maskBox, regionMask = self.region.rasterise(height, width)
+        x0, y0, x1, y1 = self.maskBox
+        if regionMask is None:
+            self.pixelCount = (x1 - x0) * (y1 - y0)
+        else:
+            self.pixelCount = cv2.countNonZero(regionMask)
+        return img[y0:y1, x0:x1], regionMask
+    
+    def classifyAll(self, channels, makeMasks = True):
+        '''calculate nonZero (and masks if makeMasks) for every channel
+        with a classifier set all channels are labelled in one pass; otherwise calcMask is
+        called once per channel. When no masks are needed and a histogram is set, counts
+        come from the histogram's summed volume table instead
+        nothing is recalculated if the frame, thresholds and region are unchanged'''
+        thresholds = tuple([(color.name, tuple(color.lower), tuple(color.upper)) for color in channels])
+        key = (self.generation, thresholds, self.regionVersion(), id(self.classifier), id(self.histogram))
+        last = self.stamps.get('classify')
+        if last is not None and last[0] == key and (last[1] or not makeMasks):
+            return
+        self.stamps['classify'] = (key, makeMasks)
+        if not makeMasks and self.histogram is not None:
+            hsvFrame, regionMask = self.regionCrop(self.ensureHSV())
+            if self.timer is not None:
+                stageStart = self.timer.clock()
+            self.histogram.compute(hsvFrame, regionMask)
+            for color in channels:
+                self.nonZero[color.name] = self.histogram.count(color.lower, color.upper)
+            if self.timer is not None:
+                self.timer.add('histogram', self.timer.clock() - stageStart)
+            return
+        if self.classifier is None:
+            for color in channels:
+                self.calcMask(color.name, lower = color.lower, upper = color.upper)
+            return
+        self.classifier.update(channels)
+        if self.classifier.usesHSV:
+            img, regionMask = self.regionCrop(self.ensureHSV())
+        else:
+            img, regionMask = self.regionCrop(self.frame)
+        if self.timer is not None:
+            stageStart = self.timer.clock()
+        self.nonZero.update(self.classifier.classify(img, regionMask))
+        if self.timer is not None:
+            self.timer.add('classify', self.timer.clock() - stageStart)
+        if makeMasks:
+            for color in channels:
+                dst = None
+                if self.timer is not None:
+                    stageStart = self.timer.clock()
+                if self.preallocate:
+                    dst = self.getBuffer('mask', color.name, shape = img.shape[:2])
+                self.mask[color.name] = self.classifier.mask(color.name, dst)
+                if self.timer is not None:
+                    self.timer.add('mask ' + color.name, self.timer.clock() - stageStart)
+                self.stamps[('mask', color.name)] = (self.generation, tuple(color.lower),
+                                                     tuple(color.upper), self.regionVersion())
+    
     def calcResult(self, name = 'defaultName'):
         '''calculate a resultant image based on bitwise anding of frame and mask
-        result - dictonary key(name): resultant mask frame'''
-        self.result[name] = cv2.bitwise_and(self.frame, self.frame, mask = self.mask[name])
+        result - dictonary key(name): resultant mask frame
+        returns False if the mask has not changed since the result was last calculated'''
+        if name in self.result and not self.needsUpdate(('result', name), self.stamps.get(('mask', name))):
+            return False
+        self.stamps[('result', name)] = self.stamps.get(('mask', name))
+        if self.mask[name].shape[:2] != self.frame.shape[:2]:
+            # the mask only covers maskBox; everything outside it is black
+            x0, y0, x1, y1 = self.maskBox
+            crop = self.frame[y0:y1, x0:x1]
+            if self.preallocate:
+                buf = self.getBuffer('result', name, 3)
+                buf.fill(0)
+                cv2.bitwise_and(crop, crop, dst = buf[y0:y1, x0:x1], mask = self.mask[name])
+            else:
+                buf = np.zeros(self.frame.shape, np.uint8)
+                buf[y0:y1, x0:x1] = cv2.bitwise_and(crop, crop, mask = self.mask[name])
+            self.result[name] = buf
+        elif self.preallocate:
+            buf = self.getBuffer('result', name, 3)
+            # masked-out pixels are left untouched in a reused dst, so clear it first
+            buf.fill(0)
+            self.result[name] = cv2.bitwise_and(self.frame, self.frame, dst = buf, mask = self.mask[name])
+        else:
+            self.result[name] = cv2.bitwise_and(self.frame, self.frame, mask = self.mask[name])
+        return True
+    
+    def displayFrame(self):
+        '''copy of the current frame for the live window to draw overlays on
+        frame itself is what gets classified, so outlines and text must never touch it'''
+        if self.preallocate and self.buffers.get('shape') == self.frame.shape[:2]:
+            np.copyto(self.buffers['display'], self.frame)
+            return self.buffers['display']
+        return self.frame.copy()
+    
+    def joinResults(self, nameA, nameB):
+        '''join two resultant frames side by side'''
+        if not self.preallocate:
+            return np.concatenate((self.result[nameA], self.result[nameB]), axis = 1)
+        if self.result[nameA].shape[:2] != self.buffers['shape']:
+            # results are from before a frame size change; buffers catch up on the next calcResult
+            return np.concatenate((self.result[nameA], self.result[nameB]), axis = 1)
+        width = self.buffers['shape'][1]
+        joined = self.buffers['joined']
+        joined[:, :width] = self.result[nameA]
+        joined[:, width:] = self.result[nameB]
+        return joined
 
 
     
@@ -530,13 +2125,14 @@ class WebSocket:
         self.socket = None
         self.connectionTime = elapsedTime()
 
-    def connect(self):
-        '''connect to a websocket server and record the attempted time'''
+    def connect(self, timeout = None):
+        '''connect to a websocket server and record the attempted time
+        timeout - seconds to wait for the connection and for each send (None blocks)'''
         self.connectionTime.setTime()
         
         #attempt to connect
         try:
-            self.socket = websocket.create_connection(self.url)
+            self.socket = websocket.create_connection(self.url, timeout = timeout)
             if self.socket.connected:
                 self.isConnected = True
         except Exception, e:
@@ -574,6 +2170,192 @@ class WebSocket:
             print 'error sending to socket:', e
             print ' is the websocket server running at', self.url + '?'
             self.isConnected = False       
+    
+    def sendBytes(self, data):
+        '''send data as a binary frame (see wire_protocol)'''
+        try:
+            self.socket.send_binary(data)
+        except Exception, e:
+            print 'error sending to socket:', e
+            print ' is the websocket server running at', self.url + '?'
+            self.isConnected = False
+
+
+class SocketSender(threading.Thread):
+    '''own the websocket connection on a background thread so the vision loop never waits on
+    the network; connecting, reconnecting and sending all happen here
+    messages queued with a kind only keep their newest value (ratio, grid); messages without
+    a kind are game commands and go through a short FIFO'''
+    def __init__(self, url, maxCommands = 16, connectTimeout = 2.0, backoff = (.25, 8.0)):
+        '''url - complete url in the form of "ws://host:port/path"
+        socket - WebSocket used only by this thread
+        isConnected - boolean; safe to read from the vision loop
+        latest - dictionary kind: (time queued, message, binary); a newer message replaces the
+                 older one
+        order - kinds in the order their current message was queued
+        commands - deque of (time queued, message, binary); the oldest is dropped when it is full
+        backoff - (first, longest) seconds between reconnect attempts; the delay doubles with
+                  every failed attempt and is jittered down by up to half
+        attempts - failed connection attempts since the last successful one
+        sent, replaced, dropped - messages sent, overwritten in latest and lost from commands
+        lastLatency, latencyTotal - seconds from queueing a message to having sent it'''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.socket = WebSocket(url)
+        self.isConnected = False
+        self.connectTimeout = connectTimeout
+        self.backoff = backoff
+        self.latest = {}
+        self.order = []
+        self.commands = collections.deque(maxlen = maxCommands)
+        self.cond = threading.Condition()
+        self.running = False
+        self.attempts = 0
+        self.sent = 0
+        self.replaced = 0
+        self.dropped = 0
+        self.lastLatency = 0.0
+        self.latencyTotal = 0.0
+    
+    def send(self, msg, kind = None, binary = False):
+        '''queue msg for sending; never blocks on the network
+        kind - only the newest message of each kind is kept; None queues msg as a command
+        binary - send msg as a binary frame (wire_protocol) instead of text'''
+        with self.cond:
+            if kind is None:
+                if len(self.commands) == self.commands.maxlen:
+                    self.dropped += 1
+                self.commands.append((monotonic(), str(msg), binary))
+            else:
+                if kind in self.latest:
+                    self.replaced += 1
+                    self.order.remove(kind)
+                self.latest[kind] = (monotonic(), str(msg), binary)
+                self.order.append(kind)
+            self.cond.notify()
+    
+    def depth(self):
+        '''number of messages waiting to be sent'''
+        with self.cond:
+            return len(self.commands) + len(self.order)
+    
+    def take(self):
+        '''pop the next (time queued, message, binary), commands first; call with self.cond held'''
+        if len(self.commands) > 0:
+            return self.commands.popleft()
+        if len(self.order) > 0:
+            return self.latest.pop(self.order.pop(0))
+        return None
+    
+    def pause(self, seconds):
+        '''sleep for seconds unless stop() is called; send() does not cut the sleep short'''
+        endTime = monotonic() + seconds
+        with self.cond:
+            while self.running:
+                remaining = endTime - monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+    
+    def run(self):
+        '''connect, then send queued messages until stopped; reconnect with backoff on failure'''
+        self.running = True
+        while self.running:
+            if not self.socket.isConnected:
+                self.isConnected = False
+                self.socket.connect(self.connectTimeout)
+                if not self.socket.isConnected:
+                    self.attempts += 1
+                    first, longest = self.backoff
+                    delay = min(longest, first * 2 ** (self.attempts - 1))
+                    # jitter so clients restarted together do not retry in lockstep
+                    self.pause(delay * random.uniform(.5, 1.0))
+                    continue
+                self.attempts = 0
+                with self.cond:
+                    # commands queued while the server was down are stale
+                    self.dropped += len(self.commands)
+                    self.commands.clear()
+                self.isConnected = True
+            with self.cond:
+                item = self.take()
+                if item is None and self.running:
+                    # send() and stop() both notify under the lock, so no notify can be missed;
+                    # a timed wait would poll (up to 50 ms per check on Python 2)
+                    self.cond.wait()
+                    item = self.take()
+            if item is None:
+                continue
+            queued, msg, binary = item
+            if binary:
+                self.socket.sendBytes(msg)
+            else:
+                self.socket.sendStr(msg)
+            if self.socket.isConnected:
+                self.sent += 1
+                self.lastLatency = monotonic() - queued
+                self.latencyTotal += self.lastLatency
+            else:
+                # the message is lost; a newer ratio follows within one heartbeat
+                self.isConnected = False
+    
+    def stop(self, timeout = 1.0):
+        '''stop the sender thread and close the connection'''
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.is_alive():
+            self.join(timeout)
+        if self.socket.socket is not None:
+            self.socket.disconnect()
+        self.isConnected = False
+    
+    def stats(self):
+        '''return a dictionary of sender statistics'''
+        meanLatency = 0.0
+        if self.sent > 0:
+            meanLatency = self.latencyTotal / self.sent
+        return {'connected': self.isConnected, 'depth': self.depth(), 'sent': self.sent,
+                'replaced': self.replaced, 'dropped': self.dropped, 'attempts': self.attempts,
+                'lastLatency': round(self.lastLatency, 4), 'meanLatency': round(meanLatency, 4)}
+    
+    def socketStats(self):
+        '''report queue depth, message counts and send latency'''
+        return (-3, 'socket stats: ' + str(self.stats()))
+
+
+class ChangeFilter:
+    '''decide which values are worth publishing
+    a value is sent when it differs from the last value sent by more than epsilon, or when a
+    heartbeat is due so clients can tell a steady value from a dead connection'''
+    def __init__(self, epsilon = .02):
+        '''epsilon - smallest change that is published
+        lastSent - last value published (None before the first)
+        sent, heartbeats, suppressed - values published on change, published as a heartbeat
+                                       and held back'''
+        self.epsilon = epsilon
+        self.lastSent = None
+        self.sent = 0
+        self.heartbeats = 0
+        self.suppressed = 0
+    
+    def check(self, value, heartbeat = False):
+        '''return True if value should be published
+        heartbeat - publish value even if it has not changed'''
+        if self.lastSent is None or abs(value - self.lastSent) > self.epsilon:
+            self.sent += 1
+        elif heartbeat:
+            self.heartbeats += 1
+        else:
+            self.suppressed += 1
+            return False
+        self.lastSent = value
+        return True
+    
+    def outputStats(self):
+        '''report values sent, sent as heartbeats and suppressed'''
+        return (-3, 'output stats: sent ' + str(self.sent) + ', heartbeats ' + str(self.heartbeats) +
+                ', suppressed ' + str(self.suppressed))
 
             
 class MsgHandler:
@@ -663,6 +2445,492 @@ class Throttle:
             return False
 
 
+class Scheduler(Throttle):
+    '''deadline scheduler with the Throttle interface
+    timers sit in a min-heap ordered by their next deadline so the main loop can sleep until the
+    earliest one is due instead of polling every timer every cycle
+    timers - dictionary timer: [time last run, rate]
+    heap - (deadline, timer) entries; an entry is stale once its deadline no longer matches
+    deadlines - dictionary timer: current deadline
+    gates - dictionary timer: callable returning a threading.Event (or None); a gated timer only
+            runs once its deadline has passed AND its event is set
+    parked - gated timers whose deadline passed while their event was clear
+    passive - timers that never wake the loop; they only run when polled with check()
+    whoever sets a gate event calls wakeUp() so wait() returns at once; wait() blocks in
+    select() on a pipe, which honours its timeout exactly (a timed Event.wait polls on
+    Python 2 and can oversleep by 50 ms)'''
+    def __init__(self, clock = monotonic):
+        Throttle.__init__(self)
+        self.clock = clock
+        self.heap = []
+        self.deadlines = {}
+        self.gates = {}
+        self.parked = set()
+        self.passive = set()
+        # self-pipe: wakeUp() writes a byte, wait() selects on the read end
+        self.wakeRead, self.wakeWrite = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    
+    def wakeUp(self):
+        '''wake wait() early; safe to call from any thread'''
+        try:
+            os.write(self.wakeWrite, 'x')
+        except OSError:
+            # the pipe is full, so wait() is going to wake anyway
+            pass
+    
+    def drain(self):
+        '''discard pending wakeUp() bytes'''
+        try:
+            while len(os.read(self.wakeRead, 512)) > 0:
+                pass
+        except OSError:
+            pass
+    
+    def close(self):
+        '''close the wake pipe'''
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
+    
+    def add(self, timer, rate = 0, gate = None, passive = False):
+        '''add a timer; its first deadline is one period from now
+        timer - name of timer
+        rate - seconds between runs
+        gate - callable returning the event that must be set before the timer runs
+        passive - only run the timer when it is polled with check()'''
+        now = self.clock()
+        self.timers[timer] = [now, rate]
+        if gate is not None:
+            self.gates[timer] = gate
+        if passive:
+            self.passive.add(timer)
+        self.schedule(timer, now + rate)
+        return True
+    
+    def delete(self, timer):
+        '''delete a timer; its heap entries are dropped lazily'''
+        Throttle.delete(self, timer)
+        self.deadlines.pop(timer, None)
+        self.gates.pop(timer, None)
+        self.parked.discard(timer)
+        self.passive.discard(timer)
+        return True
+    
+    def adjustRate(self, timer, adjust):
+        '''adjust timer rate and move its pending deadline; safe while the loop is running
+        adjust - amount to adjust by'''
+        if not Throttle.adjustRate(self, timer, adjust) or timer not in self.timers:
+            return False
+        self.timers[timer][1] = max(0, self.timers[timer][1])
+        last, rate = self.timers[timer]
+        self.schedule(timer, last + rate)
+        return True
+    
+    def setRate(self, timer, rate):
+        '''set timer rate to an absolute value'''
+        if timer not in self.timers:
+            print 'unknown timer:', timer
+            return False
+        return self.adjustRate(timer, rate - self.timers[timer][1])
+    
+    def schedule(self, timer, deadline):
+        '''record the next deadline for timer'''
+        self.deadlines[timer] = deadline
+        self.parked.discard(timer)
+        if timer not in self.passive:
+            heapq.heappush(self.heap, (deadline, timer))
+    
+    def fire(self, timer, now):
+        '''mark timer as run at <now> and schedule its next deadline'''
+        self.timers[timer][0] = now
+        self.schedule(timer, now + self.timers[timer][1])
+    
+    def timeUntil(self, timer):
+        '''seconds until the deadline of timer (negative once it has passed)'''
+        return self.deadlines[timer] - self.clock()
+    
+    def gateEvent(self, timer):
+        '''return the event gating timer or None'''
+        gate = self.gates.get(timer)
+        if gate is None:
+            return None
+        return gate()
+    
+    def isOpen(self, timer):
+        '''True if timer is not gated or its event is set'''
+        event = self.gateEvent(timer)
+        return event is None or event.is_set()
+    
+    def head(self):
+        '''return the earliest live (deadline, timer) entry, dropping stale ones; None if empty'''
+        while len(self.heap) > 0:
+            deadline, timer = self.heap[0]
+            if self.deadlines.get(timer) == deadline:
+                return self.heap[0]
+            heapq.heappop(self.heap)
+        return None
+    
+    def unpark(self):
+        '''put parked timers whose event is now set back on the heap'''
+        for timer in list(self.parked):
+            if self.isOpen(timer):
+                self.schedule(timer, self.deadlines[timer])
+    
+    def due(self):
+        '''run every timer whose deadline has passed
+        returns a list of timer names, earliest deadline first'''
+        now = self.clock()
+        self.unpark()
+        expired = []
+        entry = self.head()
+        while entry is not None and entry[0] <= now:
+            expired.append(heapq.heappop(self.heap)[1])
+            entry = self.head()
+        ready = []
+        for timer in expired:
+            if self.isOpen(timer):
+                self.fire(timer, now)
+                ready.append(timer)
+            else:
+                # wait on the gate event rather than waking at every deadline
+                self.parked.add(timer)
+        return ready
+    
+    def wait(self, maxWait = None):
+        '''sleep until the next deadline or until the event of a parked timer is set
+        maxWait - upper bound on the sleep in seconds
+        returns True if woken by an event (or wakeUp())'''
+        self.unpark()
+        timeout = maxWait
+        entry = self.head()
+        if entry is not None:
+            timeout = max(0, entry[0] - self.clock())
+            if maxWait is not None:
+                timeout = min(timeout, maxWait)
+        events = [self.gateEvent(timer) for timer in self.parked]
+        events = [event for event in events if event is not None]
+        if timeout is None and len(events) == 0:
+            # nothing scheduled and nothing to wake on
+            return False
+        if len(events) == 0:
+            # frames arriving now are not waited for, so wakeUp() is ignored
+            if timeout > 0:
+                time.sleep(timeout)
+            return False
+        # drain before checking the events so a wakeUp() after the check is not lost
+        self.drain()
+        for event in events:
+            if event.is_set():
+                return True
+        ready, _, _ = select.select([self.wakeRead], [], [], timeout)
+        return len(ready) > 0
+    
+    def check(self, timer):
+        '''poll timer like Throttle.check; runs it if its deadline passed and its gate is open'''
+        if timer not in self.timers:
+            print 'unknown timer:', timer
+            return False
+        now = self.clock()
+        if now >= self.deadlines[timer] and self.isOpen(timer):
+            self.fire(timer, now)
+            return True
+        return False
+
+
+class FrameBudget:
+    '''step frame size, sampling density and display rate down when the loop runs over budget
+    and back up when there is headroom
+    frame time is the sum of the mean time of each stage over a sliding window of runs'''
+    # (frame width, maskCalc interval, display interval) as multiples of the starting settings
+    steps = [(1.0, 1.0, 1.0), (.8, 1.0, 2.0), (.6, 1.5, 4.0), (.4, 2.0, 10.0)]
+    
+    def __init__(self, frame, throttle, msgHandler, estimator = None, budget = .04, window = 30,
+                 headroom = .6):
+        '''frame - cvFrame whose frameWidth is stepped
+        throttle - Scheduler holding the 'maskCalc' and 'display' timers
+        msgHandler - MsgHandler that level changes are reported to
+        estimator - optional RatioEstimator whose minWidth follows the frame width
+        budget - target frame time in seconds
+        window - number of runs per stage to average over
+        headroom - step back up when frame time is below headroom * budget
+        base - (frameWidth, maskCalc rate, display rate, estimator minWidth) at level 0
+        level - index into steps; 0 is full quality'''
+        self.frame = frame
+        self.throttle = throttle
+        self.msgHandler = msgHandler
+        self.estimator = estimator
+        self.budget = budget
+        self.window = window
+        self.headroom = headroom
+        self.times = {}
+        self.level = 0
+        self.enabled = True
+        minWidth = None
+        if estimator is not None:
+            minWidth = estimator.minWidth
+        self.base = (frame.frameWidth, throttle.timers['maskCalc'][1], throttle.timers['display'][1],
+                     minWidth)
+    
+    def record(self, stage, seconds):
+        '''add the duration of one run of stage'''
+        if stage not in self.times:
+            self.times[stage] = collections.deque(maxlen = self.window)
+        self.times[stage].append(seconds)
+    
+    def frameTime(self):
+        '''sum of the mean stage times; None until every stage has a full window'''
+        if len(self.times) == 0:
+            return None
+        total = 0.0
+        for samples in self.times.values():
+            if len(samples) < self.window:
+                return None
+            total += sum(samples) / len(samples)
+        return total
+    
+    def update(self):
+        '''compare frame time with the budget and change level if needed
+        returns True if the level changed'''
+        if not self.enabled:
+            return False
+        frameTime = self.frameTime()
+        if frameTime is None:
+            return False
+        if frameTime > self.budget and self.level < len(self.steps) - 1:
+            self.setLevel(self.level + 1, frameTime)
+        elif frameTime < self.headroom * self.budget and self.level > 0:
+            self.setLevel(self.level - 1, frameTime)
+        else:
+            return False
+        return True
+    
+    def setLevel(self, level, frameTime = None):
+        '''apply the settings for level and start a new measurement window'''
+        width, maskRate, displayRate, minWidth = self.base
+        widthScale, maskScale, displayScale = self.steps[level]
+        self.level = level
+        # re-selects the capture mode as well
+        self.frame.setFrameWidth(int(width * widthScale))
+        self.throttle.setRate('maskCalc', maskRate * maskScale)
+        self.throttle.setRate('display', displayRate * displayScale)
+        if self.estimator is not None:
+            self.estimator.minWidth = max(8, int(minWidth * widthScale))
+        # measurements taken at the old level say nothing about the new one
+        self.times = {}
+        msg = 'budget level ' + str(level) + ': width ' + str(self.frame.frameWidth)
+        if frameTime is not None:
+            msg += ' (frame ' + str(int(frameTime * 1000)) + 'ms)'
+        self.msgHandler.addMsg('budget', msg, False)
+    
+    def toggle(self):
+        '''switch the controller on or off; switching off restores full quality'''
+        self.enabled = not self.enabled
+        if not self.enabled:
+            self.setLevel(0)
+            self.msgHandler.delMsg('budget')
+        return (-3, 'frame budget ' + ('on' if self.enabled else 'off'))
+
+
+class LatencyHistogram:
+    '''fixed-memory histogram of durations in logarithmic buckets
+    bucket 0 holds everything up to minValue, bucket i up to minValue * growth**i and the last
+    bucket everything above maxValue; percentiles are accurate to one bucket (10% by default)'''
+    def __init__(self, minValue = 1e-6, maxValue = 10.0, growth = 1.1):
+        '''minValue, maxValue - range of durations in seconds covered by the buckets
+        growth - ratio between the upper edges of neighbouring buckets
+        count, total, max - number, sum and largest of the recorded durations'''
+        self.minValue = minValue
+        self.growth = growth
+        self.logGrowth = math.log(growth)
+        self.buckets = [0] * (int(math.ceil(math.log(maxValue / minValue) / self.logGrowth)) + 2)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def add(self, seconds):
+        '''record one duration'''
+        if seconds <= self.minValue:
+            index = 0
+        else:
+            index = min(len(self.buckets) - 1,
+                        int(math.log(seconds / self.minValue) / self.logGrowth) + 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+    
+    def percentile(self, q):
+        '''upper edge of the bucket holding the q (0-1) quantile; 0.0 if nothing was recorded'''
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and n > 0:
+                break
+        return min(self.max, self.minValue * self.growth ** index)
+    
+    def mean(self):
+        '''mean of the recorded durations'''
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+
+class StageTimer:
+    '''per-stage latency histograms for the main loop
+    callers time a stage with clock() and pass the difference to add(); leave cvFrame.timer
+    and the main loop timer at None to switch the instrumentation off'''
+    def __init__(self, clock = monotonic):
+        '''stages - dictionary stage name: LatencyHistogram
+        order - stage names in the order they were first recorded'''
+        self.clock = clock
+        self.stages = {}
+        self.order = []
+        self.startTime = clock()
+    
+    def add(self, stage, seconds):
+        '''record a duration for stage'''
+        if stage not in self.stages:
+            self.stages[stage] = LatencyHistogram()
+            self.order.append(stage)
+        self.stages[stage].add(seconds)
+    
+    def lines(self):
+        '''one 'stage p50/p99 ms' string per stage for addText'''
+        text = []
+        for stage in self.order:
+            hist = self.stages[stage]
+            text.append('%s %.1f/%.1fms' % (stage, hist.percentile(.5) * 1000,
+                                             hist.percentile(.99) * 1000))
+        return text
+    
+    def report(self):
+        '''dictionary stage: summary statistics in milliseconds'''
+        stages = {}
+        for stage in self.order:
+            hist = self.stages[stage]
+            stages[stage] = {'count': hist.count,
+                             'mean': round(hist.mean() * 1000, 3),
+                             'p50': round(hist.percentile(.5) * 1000, 3),
+                             'p90': round(hist.percentile(.9) * 1000, 3),
+                             'p99': round(hist.percentile(.99) * 1000, 3),
+                             'max': round(hist.max * 1000, 3)}
+        return {'seconds': round(self.clock() - self.startTime, 3), 'stages': stages}
+    
+    def dump(self, path):
+        '''write report() to path as JSON'''
+        try:
+            with open(path, 'w') as outFile:
+                json.dump(self.report(), outFile, indent = 2, sort_keys = True)
+        except Exception, e:
+            print 'error writing latency report:', e
+            return False
+        return True
+
+
+class CamFanIn:
+    '''classify several cameras in worker processes and merge their channel counts'''
+    def __init__(self, devices, channels, frameWidth = 500, weights = {}, maxSkew = .25):
+        '''devices - video device indexes to start a worker process for
+        channels - list of ColorHSV objects
+        weights - dictionary device: weight applied to that camera's counts (default 1.0);
+                  counts are divided by the number of pixels classified first, so frame
+                  size and region of interest do not change a camera's share
+        maxSkew - seconds; cameras whose newest result is older than the newest result
+                  from any camera by more than this are left out of the merge
+        latest - dictionary device: (capture time, dictionary name: count, pixels classified)'''
+        self.devices = list(devices)
+        self.frameWidth = frameWidth
+        self.weights = dict(weights)
+        self.maxSkew = maxSkew
+        self.settings = self.channelSettings(channels)
+        self.latest = {}
+        self.workers = {}
+        self.settingsQueues = {}
+        self.resultQueue = multiprocessing.Queue(maxsize = 4 * max(1, len(self.devices)))
+        self.stopEvent = multiprocessing.Event()
+    
+    def channelSettings(self, channels):
+        '''picklable dictionary name: (lower, upper) for the workers'''
+        settings = {}
+        for color in channels:
+            settings[color.name] = (list(color.lower), list(color.upper))
+        return settings
+    
+    def start(self):
+        '''start one capture process per device'''
+        for dev in self.devices:
+            self.settingsQueues[dev] = multiprocessing.Queue()
+            p = multiprocessing.Process(target = camWorker,
+                                        args = (dev, self.frameWidth, self.settings,
+                                                self.settingsQueues[dev], self.resultQueue,
+                                                self.stopEvent))
+            p.daemon = True
+            p.start()
+            self.workers[dev] = p
+    
+    def stop(self, timeout = 1.0):
+        '''stop all worker processes'''
+        self.stopEvent.set()
+        for dev in self.workers:
+            self.workers[dev].join(timeout)
+            if self.workers[dev].is_alive():
+                self.workers[dev].terminate()
+        self.workers = {}
+    
+    def updateChannels(self, channels):
+        '''send changed channel thresholds to every worker'''
+        settings = self.channelSettings(channels)
+        if settings == self.settings:
+            return False
+        self.settings = settings
+        for dev in self.settingsQueues:
+            self.settingsQueues[dev].put(settings)
+        return True
+    
+    def addCounts(self, dev, counts, pixels, captureTime = None):
+        '''add counts for a camera captured in this process
+        pixels - number of pixels the counts were taken over (cvFrame.pixelCount)'''
+        if captureTime is None:
+            captureTime = time.time()
+        self.latest[dev] = (captureTime, dict(counts), pixels)
+    
+    def poll(self):
+        '''collect every result the workers have produced without blocking'''
+        try:
+            while True:
+                dev, captureTime, counts, pixels = self.resultQueue.get_nowait()
+                if dev not in self.latest or captureTime > self.latest[dev][0]:
+                    self.latest[dev] = (captureTime, counts, pixels)
+        except Queue.Empty:
+            pass
+    
+    def merged(self):
+        '''weighted sum of each channel's share of the classified pixels over the cameras
+        that are in step
+        returns dictionary name: weighted fraction'''
+        total = {}
+        for name in self.settings:
+            total[name] = 0.0
+        if len(self.latest) == 0:
+            return total
+        newest = max([t for t, _, _ in self.latest.values()])
+        for dev in self.latest:
+            captureTime, counts, pixels = self.latest[dev]
+            # a slow camera is left out rather than holding back the others
+            if newest - captureTime > self.maxSkew or pixels <= 0:
+                continue
+            weight = self.weights.get(dev, 1.0) / float(pixels)
+            for name in counts:
+                if name in total:
+                    total[name] += weight * counts[name]
+        return total
+
+
 # ## Classes In Training
 
 # In[ ]:
@@ -696,20 +2964,56 @@ class ChannelSaverxxx(PickleObj):
         self.channels = self.save(self.channels)
         pass
 
+class CameraCache(PickleObj):
+    '''persist probed video devices between runs'''
+    def __init__(self, pFile):
+        self.pFile = pFile
+    
+    def loadCams(self):
+        '''return the cached dictionary index: device info; empty if there is no usable cache'''
+        try:
+            cams = self.load(self.pFile)
+        except Exception, e:
+            return {}
+        if not isinstance(cams, dict):
+            return {}
+        return cams
+    
+    def saveCams(self, cams):
+        '''cams - dictionary index: device info'''
+        try:
+            self.save(cams, self.pFile)
+        except Exception, e:
+            print 'could not save camera cache:', e
+            return False
+        return True
+
 class ChannelSaver(PickleObj):
-    def __init__(self, chan, pFile):
+    def __init__(self, chan, pFile, regions = None):
+        '''regions - optional RegionMask saved and loaded with the channels'''
         self.channel = chan
         self.pFile = pFile
+        self.regions = regions
         self.hasLoaded = False
         self.hasSaved = False
         
     def cSave(self):
-        self.save(self.channel, self.pFile)
+        if self.regions is None:
+            self.save(self.channel, self.pFile)
+        else:
+            self.save({'channels': self.channel, 'regions': self.regions.polygons()}, self.pFile)
         self.hasSaved = True
         return True
         
     def cLoad(self):
-        self.channels = self.load(self.pFile)
+        saved = self.load(self.pFile)
+        # older pickles only hold the list of channels
+        if isinstance(saved, dict):
+            self.channels = saved['channels']
+            if self.regions is not None:
+                self.regions.setPolygons(*saved['regions'])
+        else:
+            self.channels = saved
         self.hasLoaded = True
         #return self.channels
     
@@ -738,6 +3042,92 @@ class ChannelSaver(PickleObj):
 
 
 
+def replayBenchmark(source, channels, frames = 200, frameWidth = 500):
+    '''measure throughput and per-frame latency of the ratio pipeline on a FrameSource
+    no windows are opened, so this runs on a headless machine
+    source - FrameSource (realTime = False measures max speed)
+    channels - list of two ColorHSV objects
+    returns a dictionary of frames, seconds, fps, mean/max read and process times'''
+    myFrame = cvFrame(source, frameWidth = frameWidth, preallocate = True)
+    readTimes = []
+    processTimes = []
+    startTime = time.time()
+    for i in range(0, frames):
+        t0 = time.time()
+        myFrame.readFrame()
+        t1 = time.time()
+        for color in channels:
+            myFrame.calcMask(color.name, lower = color.lower, upper = color.upper)
+        ratio(myFrame.nonZero[channels[0].name], myFrame.nonZero[channels[1].name])
+        readTimes.append(t1 - t0)
+        processTimes.append(time.time() - t1)
+    seconds = time.time() - startTime
+    return {'frames': frames, 'seconds': seconds, 'fps': frames / seconds,
+            'meanRead': sum(readTimes) / frames, 'maxRead': max(readTimes),
+            'meanProcess': sum(processTimes) / frames, 'maxProcess': max(processTimes)}
+
+
+def bandBenchmark(source, channels, frames = 100, frameWidth = 1600, threadCounts = None):
+    '''measure BandClassifier throughput against thread count on a FrameSource
+    threadCounts - list of pool sizes to try; defaults to 1, 2, 4 ... up to the core count
+    returns dictionary threads: (frames per second, speed-up over one thread)'''
+    if threadCounts is None:
+        threadCounts = [1]
+        while threadCounts[-1] * 2 <= multiprocessing.cpu_count():
+            threadCounts.append(threadCounts[-1] * 2)
+    myFrame = cvFrame(source, frameWidth = frameWidth, preallocate = True)
+    # classify the same frames for every thread count
+    hsvFrames = []
+    for i in range(0, min(frames, 20)):
+        myFrame.readFrame()
+        hsvFrames.append(myFrame.ensureHSV().copy())
+    report = {}
+    for threads in threadCounts:
+        classifier = BandClassifier(threads)
+        classifier.update(channels)
+        startTime = time.time()
+        for i in range(0, frames):
+            classifier.classify(hsvFrames[i % len(hsvFrames)])
+        fps = frames / (time.time() - startTime)
+        classifier.close()
+        report[threads] = (fps, fps / report.get(threadCounts[0], (fps,))[0])
+    return report
+
+
+def cubeDivergence(source, channels, frames = 50, bits = 6, frameWidth = 500):
+    '''compare BGRCubeClassifier counts with the exact inRange path on a FrameSource
+    returns dictionary name: (mean, max) relative count error, plus 'ratio': (mean, max)
+    absolute difference of ratio() between the two paths'''
+    myFrame = cvFrame(source, frameWidth = frameWidth)
+    cube = BGRCubeClassifier(bits)
+    errors = {}
+    ratioErrors = []
+    for color in channels:
+        errors[color.name] = []
+    for i in range(0, frames):
+        myFrame.readFrame()
+        exact = {}
+        for color in channels:
+            myFrame.calcMask(color.name, lower = color.lower, upper = color.upper)
+            exact[color.name] = myFrame.nonZero[color.name]
+        cube.update(channels)
+        approx = cube.classify(myFrame.frame)
+        for color in channels:
+            errors[color.name].append(abs(approx[color.name] - exact[color.name]) /
+                                      float(max(1, exact[color.name])))
+        if len(channels) > 1:
+            a, b = channels[0].name, channels[1].name
+            ratioErrors.append(abs(ratio(approx[a], approx[b]) - ratio(exact[a], exact[b])))
+    report = {}
+    for name in errors:
+        report[name] = (sum(errors[name]) / frames, max(errors[name]))
+    if len(ratioErrors) > 0:
+        report['ratio'] = (sum(ratioErrors) / frames, max(ratioErrors))
+    return report
+
+
+# In[ ]:
+
 # # Init Objects & Vars
 
 # In[ ]:
@@ -746,7 +3136,21 @@ def main():
     color0 = 'UP - Green' # up color
     color1 = 'DOWN - Yellow' # down color
     url = 'ws://localhost:9000/ws'
+    binaryWire = True # send wire_protocol binary frames; False sends the old text messages
     chanPickleFile = './channels.pick'
+    multiCam = False # classify every connected camera and merge the counts
+    estimateRatio = False # estimate the ratio from a strided sample while the display is paused
+    # single pass classifier: 'bitplane', 'cube', 'bands', 'tiles' or None for calcMask per channel
+    classifierName = 'bitplane'
+    # count from an HSVHistogram while the display is paused; S and V limits are rounded out
+    # to 8 wide bins, so the ratio can shift when the display is paused. Off by default
+    histogramCounts = False
+    voteGrid = (4, 3) # columns, rows of the crowd heatmap sent over the socket; None to disable
+    camWeights = {} # device index: weight for multiCam
+    ratioEpsilon = .02 # smallest ratio change sent to the game
+    heartbeat = .25 # seconds between ratio messages when the ratio is steady
+    frameBudget = .04 # seconds of capture, classification and display per frame; None to disable
+    latencyReport = None # JSON file for per-stage latency written on exit; None disables timing
         
     #myConfig = ConfigParser.RawConfigParser()
     #myConfig.read(config)
@@ -755,11 +3159,40 @@ def main():
     myKeyHandler = KeyHandler()
     userMessages = MsgHandler()
     channels = [ColorHSV(color0), ColorHSV(color1)]
-    myFrame = cvFrame(0)
-    myWebSocket = WebSocket(url)
-    myThrottle = Throttle()
+    myFrame = cvFrame(0, threaded = True, preallocate = True, fps = 30, lazyDecode = True)
+    mySender = SocketSender(url)
+    mySender.start()
+    myWire = wire_protocol.Encoder(binaryWire)
+    myThrottle = Scheduler()
+    # the capture thread wakes the loop as soon as a frame arrives
+    myFrame.setOnFrame(myThrottle.wakeUp)
+    
+    myRegion = RegionMask()
+    myFrame.region = myRegion
+    classifiers = {'bitplane': BitplaneClassifier, 'cube': BGRCubeClassifier,
+                   'bands': BandClassifier, 'tiles': TileClassifier}
+    if classifierName is not None:
+        myFrame.classifier = classifiers[classifierName]()
+    if histogramCounts:
+        # counts without masks while the display is paused
+        myFrame.histogram = HSVHistogram()
+    myVoteGrid = None
+    if voteGrid is not None:
+        myVoteGrid = VoteGrid(*voteGrid)
+    gridMsg = None
+    myOutput = ChangeFilter(ratioEpsilon)
+    ratioFresh = False
+    myEstimator = None
+    if estimateRatio:
+        myEstimator = RatioEstimator()
+    myChannelSaver = ChannelSaver(channels, chanPickleFile, myRegion)
     
-    myChannelSaver = ChannelSaver(channels, chanPickleFile)
+    myFanIn = None
+    if multiCam:
+        # this process keeps capturing myFrame.videoDev; every other camera gets a process
+        otherCams = [i for i in myFrame.connectedCams if i != myFrame.videoDev]
+        myFanIn = CamFanIn(otherCams, channels, myFrame.frameWidth, camWeights)
+        myFanIn.start()
     
     # add keys, objects, methods and help strings to the key handler
     myKeyHandler.addKey('h', myKeyHandler, 'displayHelp', 'display this help screen')
@@ -782,20 +3215,47 @@ def main():
     myKeyHandler.addKey('=', myFrame, 'increaseFrameSize', 'increase frame size')
     myKeyHandler.addKey('0', myFrame, 'resetFrameSize', 'reset frame size to default (500px)')    
     myKeyHandler.addKey('V', myFrame, 'changeVideo', 'change video device to next availalbe camera')
+    myKeyHandler.addKey('c', myFrame, 'captureStats', 'display capture thread frame statistics')
+    myKeyHandler.addKey('w', mySender, 'socketStats', 'display websocket queue and latency statistics')
+    myKeyHandler.addKey('o', myOutput, 'outputStats', 'display ratio messages sent and suppressed')
+    myKeyHandler.addKey('r', myRegion, 'closeROI', 'close clicked points as a region of interest')
+    myKeyHandler.addKey('x', myRegion, 'closeExclusion', 'close clicked points as an excluded region')
+    myKeyHandler.addKey('z', myRegion, 'clear', 'clear regions of interest and exclusions')
         
     # add throttle objects
     myThrottle.add('trackBars', .5)
     myThrottle.add('maskCalc', .05)
-    myThrottle.add('capture', .05)
-    #myThrottle.add('socket', 0) # this has < 1% CPU impact and can delay or miss messages sent to game
+    # capture runs when a new frame arrives, at most every .05s
+    myThrottle.add('capture', .05, gate = myFrame.frameEvent)
+    # the ratio is sent when it changes and at least this often; commands are sent as soon as a key returns one
+    myThrottle.add('heartbeat', heartbeat)
     myThrottle.add('display', .05)
+    myThrottle.add('grid', .5, passive = True) # heatmap is sent at a lower rate than the ratio
+    myThrottle.add('budget', 1)
+    
+    myTimer = None
+    if latencyReport is not None:
+        myTimer = StageTimer()
+        myFrame.timer = myTimer
+    
+    myBudget = None
+    if frameBudget is not None:
+        myBudget = FrameBudget(myFrame, myThrottle, userMessages, myEstimator, frameBudget)
+        myKeyHandler.addKey('b', myBudget, 'toggle', 'toggle automatic frame size and display rate')
+    
+    def recordStage(stage, stageStart):
+        '''time one run of a main loop stage once and feed both the budget and the latency report'''
+        seconds = monotonic() - stageStart
+        if myBudget is not None:
+            myBudget.record(stage, seconds)
+        if myTimer is not None:
+            myTimer.add(stage, seconds)
+    
+    keyPoll = .05 # longest the loop sleeps before servicing HighGUI and the keyboard
   
-    # bodge for initing camera
-    for i in range(0, 30):
-        cap = cv2.VideoCapture(0)
-        _, frame = cap.read()
-        cv2.imshow('init' , frame)
-    cap.release()
+    # wait for the camera's auto exposure to settle
+    ready, frames, warmTime = myFrame.warmUp(timeout = 5.0, winName = 'init')
+    print 'camera ready:', ready, 'after', frames, 'frames', round(warmTime, 2), 's'
     cv2.destroyWindow('init')
     #cv2.destroyAllWindows()
     #cv2.waitKey(1)
@@ -803,6 +3263,9 @@ def main():
     # create trackbar windows
     for color in channels:
         color.createTrackBars()
+    # click on the live window to draw region polygons
+    cv2.namedWindow(myFrame.name)
+    cv2.setMouseCallback(myFrame.name, myRegion.mouseEvent)
 
     # bodge for ensuring that everything initializes properly with the throttle
     # read one frame
@@ -817,22 +3280,31 @@ def main():
         
     # main loop
     while True:
+        # sleep until the next task is due or the capture thread has a new frame
+        myThrottle.wait(keyPoll)
         try:
             # get key input every cycle and it's response
             myKeyHandler.handleKey(cv2.waitKey(1))
         except LoopHalt:
             break
+        tasks = myThrottle.due()
 
         # read current frame
         # throttle 
-        if myThrottle.check('capture'):
+        if 'capture' in tasks:
+            stageStart = monotonic()
             myFrame.readFrame()
+            # a lazy capture thread decodes only from just before the next capture
+            myFrame.expectFrame(myThrottle.timeUntil('capture'))
+            recordStage('capture', stageStart)
 
         # split into two sepperate for loops for independent throttling
-        if myThrottle.check('trackBars'):
+        if 'trackBars' in tasks:
             # update trackbars
             for color in channels:
                 color.syncTrackBars()
+            if myFanIn is not None:
+                myFanIn.updateChannels(channels)
 
                 
         ####FIXME this checks for an update to the channel saver EVERY loop 
@@ -852,35 +3324,66 @@ def main():
             # need to make a method that moves the trackbars
                 
         # throttle mask calculation and ratio calculation
-        if myThrottle.check('maskCalc'):
-            # calculate mask and resultant frames
-            for color in channels:  
-                myFrame.calcMask(color.name, lower = color.lower, upper = color.upper)
+        if 'maskCalc' in tasks:
+            stageStart = monotonic()
+            if myEstimator is not None and not myRunTime.displayOn and myFanIn is None:
+                # nothing to display; classify only as many pixels as the command needs
+                # from the analysis frame, which the live window overlays never touch
+                if myTimer is not None:
+                    ratioStart = myTimer.clock()
+                colorRatio = myEstimator.estimate(myFrame.frame, channels[0], channels[1], myRegion)
+                if myTimer is not None:
+                    myTimer.add('estimate', myTimer.clock() - ratioStart)
+            else:
+                gridDue = myVoteGrid is not None and myThrottle.check('grid')
+                # calculate mask and resultant frames
+                myFrame.classifyAll(channels, makeMasks = myRunTime.displayOn or gridDue)
+                if gridDue:
+                    myVoteGrid.compute(myFrame.mask, color0, color1)
+                    gridMsg = myVoteGrid.message()
                 # only calculate resultant frames if the display is on
                 if myRunTime.displayOn:
-                    myFrame.calcResult(color.name)
-            # moved into throttle check
-            # calculate ratio of pixels in each channel 
-            colorRatio = ratio(myFrame.nonZero[color0], myFrame.nonZero[color1])
+                    for color in channels:
+                        myFrame.calcResult(color.name)
+                # moved into throttle check
+                # calculate ratio of pixels in each channel 
+                if myTimer is not None:
+                    ratioStart = myTimer.clock()
+                if myFanIn is not None:
+                    myFanIn.addCounts(myFrame.videoDev, myFrame.nonZero, myFrame.pixelCount,
+                                      myFrame.captureTime)
+                    myFanIn.poll()
+                    counts = myFanIn.merged()
+                    colorRatio = ratio(counts[color0], counts[color1])
+                else:
+                    colorRatio = ratio(myFrame.nonZero[color0], myFrame.nonZero[color1])
+                if myTimer is not None:
+                    myTimer.add('ratio', myTimer.clock() - ratioStart)
             userMessages.addMsg('ratio', 'ratio: ' + str(colorRatio), False)        
+            ratioFresh = True
+            recordStage('maskCalc', stageStart)
 
-        # add message text to the frame
-        msgList = []
-        for key in userMessages.msgList:
-            msgList.append(userMessages.msgList[key])
-        addText(myFrame.frame, msgList)
-
-        # check web socket state
-        if myWebSocket.isConnected:
+        # check web socket state; the sender thread connects and reconnects on its own
+        if mySender.isConnected:
             # send command messages to the web socket
             if len(myKeyHandler.methodReturn) > 0 and myKeyHandler.methodReturn[0] > 0:
-                myWebSocket.sendStr(myKeyHandler.methodReturn[0])
-            # send color ratio to web socket
-            myWebSocket.sendStr(colorRatio)
+                mySender.send(myWire.command(myKeyHandler.methodReturn[0]), binary = binaryWire)
+            if ratioFresh or 'heartbeat' in tasks:
+                if myTimer is not None:
+                    sendStart = myTimer.clock()
+                # queue color ratio for the web socket if it moved or a heartbeat is due
+                if myOutput.check(colorRatio, heartbeat = 'heartbeat' in tasks):
+                    mySender.send(myWire.ratio(colorRatio, myFrame.captureTime), 'ratio', binaryWire)
+                ratioFresh = False
+                if myTimer is not None:
+                    myTimer.add('socket', myTimer.clock() - sendStart)
+            if gridMsg is not None:
+                # the heatmap is variable length and stays a text message
+                mySender.send(gridMsg, 'grid')
+                gridMsg = None
             # remove websocket errors
             userMessages.delMsg('error.websocket')
         else:
-            myWebSocket.reconnect(3)
             # add an error message to the list and unpause the display
             userMessages.addMsg('error.websocket', 'socket server disconnected', False)
             myRunTime.displayOn = True
@@ -888,6 +3391,9 @@ def main():
         # display runtime commands on terminal
         if len(myKeyHandler.methodReturn) > 0:
             print myKeyHandler.methodReturn
+            # and key reports (capture, socket and output stats) on the live window
+            if myKeyHandler.methodReturn[0] == -3 and len(myKeyHandler.methodReturn[1]) > 0:
+                userMessages.addMsg('key', myKeyHandler.methodReturn[1], False)
 
 
         ####FIXME bodge for adding upper and lower text to each frame
@@ -897,13 +3403,27 @@ def main():
             channelInfo[color.name] = (color.lower, color.upper)
 
         # throttle display output
-        if myThrottle.check('display'):
+        if 'display' in tasks:
+            stageStart = monotonic()
             # update live and resultant windows
             if myRunTime.displayOn:
-                #live window
-                cv2.imshow(myFrame.name, myFrame.frame)
+                #live window; overlays go on a copy so they are never classified
+                liveFrame = myFrame.displayFrame()
+                # add message text to the live window
+                msgList = []
+                for key in userMessages.msgList:
+                    msgList.append(userMessages.msgList[key])
+                addText(liveFrame, msgList)
+                myRegion.draw(liveFrame)
+                if myTimer is not None:
+                    # p50/p99 per stage down the right half of the live window
+                    addText(liveFrame, myTimer.lines(), xPos = liveFrame.shape[1] // 2, size = .8)
+                cv2.imshow(myFrame.name, liveFrame)
 
                 for key in myFrame.result:
+                    # only draw on results that were recalculated since the last overlay
+                    if not myFrame.needsUpdate(('overlay', key), myFrame.stamps.get(('result', key))):
+                        continue
                     # bodge for adding text for testing
                     resultText = []
                     resultText.append('NonZero Px: ' + str(myFrame.nonZero[key]) )
@@ -911,22 +3431,33 @@ def main():
                     resultText.append('U: ' + str(channelInfo[key][1]))
                     #addText(myFrame.result[key], ['NonZero Px: ' + str(myFrame.nonZero[key]) ])
                     addText(myFrame.result[key], resultText)
-                # this is a bit kludgy, but it is the simplest way to join two frames together
-                cv2.imshow('Up & Down', np.concatenate((myFrame.result[color0], myFrame.result[color1]), axis = 1))
+                cv2.imshow('Up & Down', myFrame.joinResults(color0, color1))
+            recordStage('display', stageStart)
+
+        if 'budget' in tasks and myBudget is not None:
+            myBudget.update()
 
     # clean up 
+    if myTimer is not None:
+        myTimer.dump(latencyReport)
+        print 'latency report written to', latencyReport
     # release video devices
     myFrame.release()
+    if myFanIn is not None:
+        myFanIn.stop()
     # clean up windows
     cv2.destroyAllWindows()
     cv2.waitKey(1)
     # close websocket
-    myWebSocket.disconnect()
+    mySender.stop()
+    myThrottle.close()
 
 
 # In[ ]:
 
-main()
+# guarded so replayBenchmark and the frame sources can be imported without a camera
+if __name__ == '__main__':
+    main()
 
 
 # In[ ]:
@@ -942,8 +3473,9 @@ main()
 # In[ ]:
 
 #myFrame.release()
-cv2.destroyAllWindows()
-cv2.waitKey(1)
+if __name__ == '__main__':
+    cv2.destroyAllWindows()
+    cv2.waitKey(1)
 
 
 # In[ ]:
@@ -6,6 +6,38 @@ import tornado.web
 import tornado.websocket
 import tornado.template
 import random
+import struct
+import collections
+import wire_protocol
+
+# re-encodes text messages for clients that asked for binary frames
+encoder = wire_protocol.Encoder()
+
+# outbound frames queued per connection before the slow consumer policy applies
+maxQueue = 32
+# what to do with a connection whose queue is full (clients may pick one with ?policy=):
+#   conflate - replace a queued value of the same kind with the newer one, else drop the oldest
+#   drop-oldest - drop the oldest queued frame
+#   disconnect - close the connection
+slowPolicy = 'conflate'
+policies = ('conflate', 'drop-oldest', 'disconnect')
+# kinds where only the newest value matters; points, game over and commands are never conflated
+conflateKinds = (wire_protocol.RATIO, wire_protocol.SCORE, 'grid')
+
+def websocketFrame(payload, binary = False):
+  '''complete server-to-client websocket frame (RFC 6455: FIN set, unmasked) for payload
+  frames from the server are not masked, so one frame can be written to every connection'''
+  if isinstance(payload, unicode):
+    payload = payload.encode('utf-8')
+  opcode = 0x2 if binary else 0x1
+  length = len(payload)
+  if length < 126:
+    head = struct.pack('!BB', 0x80 | opcode, length)
+  elif length <= 0xffff:
+    head = struct.pack('!BBH', 0x80 | opcode, 126, length)
+  else:
+    head = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+  return head + payload
 
 class MainHandler(tornado.web.RequestHandler):
 
@@ -20,19 +52,130 @@ class WSHandler(tornado.websocket.WebSocketHandler):
   def check_origin(self, origin):
     return True
 
+  # broadcast() writes pre-encoded frames straight to the stream, which is only valid
+  # without per-message compression
+  def get_compression_options(self):
+    return None
+
   def open(self):
     print 'connection opened...'
+    # clients connecting with ?format=binary get wire_protocol frames; everyone else gets text
+    self.binary = self.get_argument('format', 'text') == 'binary'
+    self.policy = self.get_argument('policy', slowPolicy)
+    if self.policy not in policies:
+      self.policy = slowPolicy
+    self.failed = False
+    self.badFrames = 0
+    # outbound (kind, frame) queue; only one frame at a time is handed to the stream
+    self.queue = collections.deque()
+    self.writing = False
+    self.highWater = 0
+    self.conflated = 0
+    self.dropped = 0
     self.write_message("The server says: 'Hello'. Connection was accepted.")
     self.connections.add(self)
 
   def on_message(self, message):
-    foo = random.random()
     #self.write_message(message)
     #self.send(message)
-    print 'received:', message
-    [con.write_message(message) for con in self.connections]
-    #for con in self.connections:
-    #  self.write_message(message)
+    try:
+      msg = wire_protocol.decode(message)
+    except wire_protocol.WireError, e:
+      if wire_protocol.isBinary(message):
+        # counted rather than printed; reported when the connection closes
+        self.badFrames += 1
+        return
+      # text the protocol does not cover (e.g. #GRID: ...#) is passed through as is
+      msg = None
+    if msg is None:
+      kind = 'grid' if message.startswith('#GRID') else None
+      self.broadcast(message, message, kind)
+    elif wire_protocol.isBinary(message):
+      self.broadcast(wire_protocol.toText(msg), message, msg.kind)
+    else:
+      self.broadcast(wire_protocol.toText(msg), lambda: encoder.encode(msg), msg.kind)
+
+  def broadcast(self, textForm, binaryForm, kind = None):
+    '''write a message to every connection except this one
+    each form is framed once, and only if a connection wants it; binaryForm may be a callable
+    that builds the payload. Connections that fail are closed and removed afterwards
+    kind - message kind used to conflate queued values (None is never conflated)'''
+    frames = {}
+    for con in list(self.connections):
+      if con is self:
+        continue
+      if con.binary not in frames:
+        if con.binary:
+          payload = binaryForm() if callable(binaryForm) else binaryForm
+          # text the protocol does not cover goes to binary clients as text
+          frames[True] = websocketFrame(payload, not isinstance(payload, unicode) and
+                                        wire_protocol.isBinary(payload))
+        else:
+          frames[False] = websocketFrame(textForm)
+      con.writeFrame(frames[con.binary], kind)
+    self.reap()
+
+  def writeFrame(self, frame, kind = None):
+    '''queue a pre-encoded frame for this connection, applying the slow consumer policy
+    when the queue is full; errors only mark the connection failed'''
+    if self.failed:
+      return False
+    if self.policy == 'conflate' and kind in conflateKinds:
+      for index, (queuedKind, queuedFrame) in enumerate(self.queue):
+        if queuedKind == kind:
+          self.queue[index] = (kind, frame)
+          self.conflated += 1
+          return True
+    if len(self.queue) >= maxQueue:
+      if self.policy == 'disconnect':
+        self.failed = True
+        return False
+      self.queue.popleft()
+      self.dropped += 1
+    self.queue.append((kind, frame))
+    self.highWater = max(self.highWater, len(self.queue))
+    self.pump()
+    return not self.failed
+
+  def pump(self):
+    '''hand the next queued frame to the stream once the previous one has been written
+    so tornado's write buffer never holds more than one broadcast frame per connection'''
+    while not self.writing and not self.failed and len(self.queue) > 0:
+      if self.ws_connection is None or self.ws_connection.stream.closed():
+        self.failed = True
+        return
+      kind, frame = self.queue.popleft()
+      try:
+        future = self.ws_connection.stream.write(frame)
+      except Exception:
+        self.failed = True
+        return
+      self.writing = True
+      future.add_done_callback(self.writeDone)
+
+  def writeDone(self, future):
+    '''send the next queued frame, or mark the connection failed if the write failed'''
+    self.writing = False
+    if future.exception() is not None:
+      self.failed = True
+      return
+    self.pump()
+
+  def stats(self):
+    '''dictionary of outbound queue statistics for this connection'''
+    return {'remote': self.request.remote_ip, 'binary': self.binary, 'policy': self.policy,
+            'depth': len(self.queue), 'highWater': self.highWater, 'conflated': self.conflated,
+            'dropped': self.dropped, 'failed': self.failed}
+
+  @classmethod
+  def reap(cls):
+    '''close and forget connections whose writes failed'''
+    for con in [con for con in cls.connections if con.failed]:
+      cls.connections.discard(con)
+      try:
+        con.close()
+      except Exception:
+        pass
 
 
   def send(self, message):
@@ -41,9 +184,20 @@ class WSHandler(tornado.websocket.WebSocketHandler):
   def on_close(self):
     self.connections.discard(self) #I think this was the killer line :) -JM
     print 'connection closed...'
+    if getattr(self, 'badFrames', 0) > 0:
+      print ' dropped', self.badFrames, 'bad frames from this connection'
+    if getattr(self, 'highWater', 0) > 0:
+      print ' queue high-water mark', self.highWater, 'conflated', self.conflated, 'dropped', self.dropped
+
+class StatsHandler(tornado.web.RequestHandler):
+
+  def get(self):
+    # per connection outbound queue depth and high-water marks as JSON
+    self.write({'maxQueue': maxQueue, 'connections': [con.stats() for con in WSHandler.connections]})
 
 application = tornado.web.Application([
   (r'/ws', WSHandler),
+  (r'/stats', StatsHandler),
   (r'/', MainHandler),
   (r"/(.*)", tornado.web.StaticFileHandler, {"path": "./resources"}),
 ])
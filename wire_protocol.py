@@ -0,0 +1,192 @@
+
+# coding: utf-8
+
+# # Crowd Pong wire protocol
+# shared by the capture client (cp_rewrite.py), the tornado server and the game simulator
+# (write_to_websocket.py)
+#
+# binary frame: header + fixed size payload, network byte order
+#
+#     version  uint8    VERSION
+#     type     uint8    RATIO, COMMAND, SCORE, POINT or GAMEOVER
+#     seq      uint32   per-encoder sequence number (wraps)
+#     time     float64  capture/creation time in seconds since the epoch
+#     payload  see payloads below
+#
+# the text messages used before the binary framing remain the fallback:
+# ratio "0.25", command "3", "#SCORE: AI:1; Human:2#", "#POINT: AI#", "#GAMEOVER: Winner: Human#"
+
+# In[ ]:
+
+import re
+import struct
+import time
+import collections
+
+VERSION = 1
+
+RATIO = 1
+COMMAND = 2
+SCORE = 3
+POINT = 4
+GAMEOVER = 5
+
+# who scored or won
+AI = 0
+HUMAN = 1
+entityNames = {AI: 'AI', HUMAN: 'Human'}
+
+header = struct.Struct('!BBId')
+payloads = {RATIO: struct.Struct('!h'),      # ratio * RATIO_SCALE
+            COMMAND: struct.Struct('!B'),    # RunTime command (2-6)
+            SCORE: struct.Struct('!HH'),     # AI score, Human score
+            POINT: struct.Struct('!B'),      # entity that scored
+            GAMEOVER: struct.Struct('!B')}   # entity that won
+RATIO_SCALE = 32767
+
+# kind - message type; seq and timestamp are None for text messages
+Message = collections.namedtuple('Message', 'kind seq timestamp value')
+
+
+class WireError(ValueError):
+    '''data is not a valid binary or text message'''
+    pass
+
+
+# In[ ]:
+
+def quantise(value):
+    '''ratio (-1.0 to 1.0) as an int16'''
+    return int(round(max(-1.0, min(1.0, value)) * RATIO_SCALE))
+
+
+def isBinary(data):
+    '''True if data looks like a binary frame rather than a text message'''
+    # no text message starts with a control character
+    if isinstance(data, unicode) or len(data) == 0:
+        return False
+    return ord(data[0]) == VERSION
+
+
+def decodeBinary(data):
+    '''decode a binary frame into a Message'''
+    if len(data) < header.size:
+        raise WireError('short frame: ' + str(len(data)) + ' bytes')
+    version, kind, seq, timestamp = header.unpack_from(data)
+    if version != VERSION:
+        raise WireError('unsupported version: ' + str(version))
+    if kind not in payloads:
+        raise WireError('unknown message type: ' + str(kind))
+    payload = payloads[kind]
+    if len(data) != header.size + payload.size:
+        raise WireError('bad length for type ' + str(kind) + ': ' + str(len(data)) + ' bytes')
+    fields = payload.unpack_from(data, header.size)
+    if kind == RATIO:
+        value = fields[0] / float(RATIO_SCALE)
+    elif kind == SCORE:
+        value = fields
+    else:
+        value = fields[0]
+    return Message(kind, seq, timestamp, value)
+
+
+def entity(name):
+    '''AI or HUMAN from the text form'''
+    for key, value in entityNames.items():
+        if value == name:
+            return key
+    raise WireError('unknown entity: ' + name)
+
+
+def decodeText(data):
+    '''decode a text message into a Message; seq and timestamp are None'''
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    data = str(data).strip()
+    match = re.match(r'^#SCORE: AI:(\d+); Human:(\d+)#$', data)
+    if match is not None:
+        return Message(SCORE, None, None, (int(match.group(1)), int(match.group(2))))
+    match = re.match(r'^#POINT: (\w+)#$', data)
+    if match is not None:
+        return Message(POINT, None, None, entity(match.group(1)))
+    match = re.match(r'^#GAMEOVER: Winner: (\w+)#$', data)
+    if match is not None:
+        return Message(GAMEOVER, None, None, entity(match.group(1)))
+    if re.match(r'^\d+$', data):
+        return Message(COMMAND, None, None, int(data))
+    try:
+        return Message(RATIO, None, None, float(data))
+    except ValueError:
+        raise WireError('unknown text message: ' + data)
+
+
+def decode(data):
+    '''decode a binary frame or a text message into a Message'''
+    if isBinary(data):
+        return decodeBinary(data)
+    return decodeText(data)
+
+
+def toText(msg):
+    '''text form of a Message for clients that do not speak the binary protocol'''
+    if msg.kind == RATIO:
+        # int16 quantisation is good to about 3e-5
+        return str(round(msg.value, 4))
+    if msg.kind == COMMAND:
+        return str(msg.value)
+    if msg.kind == SCORE:
+        return '#SCORE: AI:' + str(msg.value[0]) + '; Human:' + str(msg.value[1]) + '#'
+    if msg.kind == POINT:
+        return '#POINT: ' + entityNames[msg.value] + '#'
+    if msg.kind == GAMEOVER:
+        return '#GAMEOVER: Winner: ' + entityNames[msg.value] + '#'
+    raise WireError('unknown message type: ' + str(msg.kind))
+
+
+# In[ ]:
+
+class Encoder:
+    '''encode messages as binary frames or, with binary False, as the old text messages'''
+    def __init__(self, binary = True):
+        '''binary - emit binary frames (False emits the text fallback)
+        seq - sequence number of the last binary frame'''
+        self.binary = binary
+        self.seq = 0
+
+    def frame(self, kind, timestamp, *fields):
+        '''header + payload for a message of type kind'''
+        self.seq = (self.seq + 1) & 0xffffffff
+        if timestamp is None:
+            timestamp = time.time()
+        return header.pack(VERSION, kind, self.seq, timestamp) + payloads[kind].pack(*fields)
+
+    def encode(self, msg, timestamp = None):
+        '''encode a decoded Message (used to re-encode text messages as binary and back)'''
+        if not self.binary:
+            return toText(msg)
+        if msg.kind == RATIO:
+            return self.frame(RATIO, timestamp, quantise(msg.value))
+        if msg.kind == SCORE:
+            return self.frame(SCORE, timestamp, *msg.value)
+        return self.frame(msg.kind, timestamp, msg.value)
+
+    def ratio(self, value, timestamp = None):
+        '''ratio between -1.0 and 1.0
+        timestamp - time the frame the ratio came from was captured (default now)'''
+        return self.encode(Message(RATIO, None, None, value), timestamp)
+
+    def command(self, code):
+        '''RunTime command'''
+        return self.encode(Message(COMMAND, None, None, int(code)))
+
+    def score(self, ai, human):
+        '''current score'''
+        return self.encode(Message(SCORE, None, None, (int(ai), int(human))))
+
+    def point(self, who):
+        '''AI or HUMAN just scored'''
+        return self.encode(Message(POINT, None, None, who))
+
+    def gameOver(self, winner):
+        '''AI or HUMAN won'''
+        return self.encode(Message(GAMEOVER, None, None, winner))
@@ -6,6 +6,10 @@
 from websocket import create_connection
 import random
 import time
+import wire_protocol
+
+binary = True # send wire_protocol frames; False sends the old text messages
+encoder = wire_protocol.Encoder(binary)
 
 def formatOutput(msg):
     '''format a message with the appropriate pre/postfix'''
@@ -17,32 +21,25 @@ def formatOutput(msg):
 def randReal():
     time.sleep(0.4)
     num = (random.random()*2)-1
-    return str(num)
+    return encoder.ratio(num)
 
 def randInt():
     return str(random.randrange(0, 10))
 
 def outScore():
     '''output the a score'''
-    return formatOutput('SCORE: AI:' + randInt()+ '; Human:' + randInt())
+    return encoder.score(randInt(), randInt())
 
 def outPoint():
     '''output who just scored'''
+    # 0 = wire_protocol.AI, 1 = wire_protocol.HUMAN
     entity = random.randrange(0, 2)
-    if entity == 0:
-        output = formatOutput('POINT: AI')
-    else:
-        output = formatOutput('POINT: Human')
-    return output
+    return encoder.point(entity)
 
 def outGameOver():
     '''output game-over status'''
     entity = random.randrange(0, 2)
-    if entity == 0:
-        output = formatOutput('GAMEOVER: Winner: AI')
-    else:
-        output = formatOutput('GAMEOVER: Winner: Human')
-    return output
+    return encoder.gameOver(entity)
 
 
 def randomOutput():
@@ -53,15 +50,22 @@ def randomOutput():
     
     return output
 
+def send(ws, msg):
+    '''send a message from the encoder as a binary frame or as text'''
+    if binary:
+        ws.send_binary(msg)
+    else:
+        ws.send(msg)
+
 ws = create_connection("ws://localhost:9000/ws")
 count = 0 
 while True:
     # simulate sending video capture data
-    ws.send(randReal())
+    send(ws, randReal())
     
     #simulate sending game results
     if random.randrange(0, 100) < 10:
-        ws.send(randomOutput())
+        send(ws, randomOutput())
 
 # well, this is rather pointless.  We never get here.
 ws.close